@@ -0,0 +1,308 @@
+""" benchmark.py - Benchmarks of the segmentation, serialization and reassembly hot paths
+
+Results are written as JSON so runs of different releases can be compared, eg.
+
+    $ python benchmark.py --output before.json
+    $ git checkout <new release>
+    $ python benchmark.py --compare before.json
+
+The radio is replaced by mesh_transport.SimulatedMesh with no airtime or latency,
+so the end to end benchmark measures only the work done by txtenna.py. Inputs are
+generated from a fixed seed so every run processes the same data.
+"""
+from __future__ import print_function
+import argparse
+import binascii
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+from time import time, sleep
+
+from txtenna_segment import TxTennaSegment
+from segment_storage import SegmentStorage
+
+## size in bytes of a typical transaction
+TX_SIZE = 250
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """ Register func(rng, quick) as a benchmark
+
+    func returns (params, run), where run() does the work once and returns
+    (operations, bytes processed).
+    """
+    BENCHMARKS.append(func)
+    return func
+
+@contextmanager
+def quiet():
+    """ Discard what txtenna.py prints, including from its threads, while the benchmarks run
+
+    Returns the original standard output.
+    """
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield stdout
+        finally:
+            sys.stdout = stdout
+
+def random_tx(rng, size):
+    """ (hex transaction, hex hash) of size random bytes
+    """
+    data = bytearray(rng.getrandbits(8) for _ in range(size))
+    tx = binascii.hexlify(data)
+    tx_hash = binascii.hexlify(bytearray(rng.getrandbits(8) for _ in range(32)))
+    return (tx, tx_hash)
+
+def tx_to_segments_benchmark(name, size, isZ85, count):
+    def setup(rng, quick):
+        n = max(1, count // 10) if quick else count
+        txs = [random_tx(rng, size) for _ in range(n)]
+        def run():
+            total = 0
+            for (idx, (tx, tx_hash)) in enumerate(txs):
+                TxTennaSegment.tx_to_segments(1234, tx, tx_hash, str(idx), 'm', isZ85)
+                total += len(tx) // 2
+            return (len(txs), total)
+        return ({'tx_bytes': size, 'z85': isZ85, 'txs': n}, run)
+    setup.__name__ = name
+    return benchmark(setup)
+
+tx_to_segments_benchmark('tx_to_segments_tx_hex', TX_SIZE, False, 2000)
+tx_to_segments_benchmark('tx_to_segments_tx_z85', TX_SIZE, True, 2000)
+tx_to_segments_benchmark('tx_to_segments_1mb_hex', 1024 * 1024, False, 1)
+tx_to_segments_benchmark('tx_to_segments_1mb_z85', 1024 * 1024, True, 1)
+
+def serialization_benchmark(name, binary, deserialize):
+    def setup(rng, quick):
+        segments = []
+        for idx in range(100 if quick else 1000):
+            (tx, tx_hash) = random_tx(rng, TX_SIZE)
+            segments.extend(TxTennaSegment.tx_to_segments(1234, tx, tx_hash, str(idx), 'm', False, binary))
+        frames = [s.serialize_to_binary() if binary else s.serialize_to_json() for s in segments]
+        def run():
+            if deserialize:
+                for frame in frames:
+                    TxTennaSegment.deserialize_from_json(frame)
+            elif binary:
+                for segment in segments:
+                    segment.serialize_to_binary()
+            else:
+                for segment in segments:
+                    segment.serialize_to_json()
+            return (len(frames), sum(len(frame) for frame in frames))
+        return ({'segments': len(segments), 'binary': binary}, run)
+    setup.__name__ = name
+    return benchmark(setup)
+
+serialization_benchmark('serialize_json', False, False)
+serialization_benchmark('deserialize_json', False, True)
+serialization_benchmark('serialize_binary', True, False)
+serialization_benchmark('deserialize_binary', True, True)
+
+@benchmark
+def storage_interleaved(rng, quick):
+    """ Reassemble thousands of transactions from their segments, interleaved and out of order
+    """
+    n = 300 if quick else 3000
+    segments = []
+    for idx in range(n):
+        (tx, tx_hash) = random_tx(rng, rng.randint(TX_SIZE // 2, TX_SIZE * 4))
+        segments.extend(TxTennaSegment.tx_to_segments(1234, tx, tx_hash, str(idx), 'm'))
+    rng.shuffle(segments)
+    def run():
+        storage = SegmentStorage(max_payloads=n + 1, max_bytes=1 << 30)
+        completed = 0
+        total = 0
+        for segment in segments:
+            storage.put(segment)
+            if storage.is_complete(segment.payload_id):
+                total += len(storage.get_raw_tx(storage.get(segment.payload_id))) // 2
+                storage.remove(segment.payload_id)
+                completed += 1
+        assert completed == n
+        return (len(segments), total)
+    return ({'payloads': n, 'segments': len(segments)}, run)
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+def mesh_loop_benchmark(name, sizes, binary, parity):
+    def setup(rng, quick):
+        import mesh_transport
+        import txtenna
+
+        send_dir = tempfile.mkdtemp()
+        receive_dir = tempfile.mkdtemp()
+        files = []
+        for (idx, size) in enumerate(sizes[:1] if quick else sizes):
+            filename = 'file{}'.format(idx)
+            with open(os.path.join(send_dir, filename), 'wb') as f:
+                ## compressible text, like most Blocksat messages
+                f.write(' '.join(str(rng.randint(0, 1 << 16)) for _ in range(size // 6))[:size])
+            files.append(filename)
+        total = sum(os.path.getsize(os.path.join(send_dir, f)) for f in files)
+        digests = dict((f, file_digest(os.path.join(send_dir, f))) for f in files)
+
+        mesh = mesh_transport.SimulatedMesh(bitrate=0, frame_overhead=0, latency=0, seed=rng.randint(0, 1 << 30))
+        sender = txtenna.goTennaCLI(transport_factory=mesh.transport_factory)
+        gateway = txtenna.goTennaCLI(transport_factory=mesh.transport_factory)
+        for (cli, gid) in ((sender, '1111'), (gateway, '2222')):
+            cli.do_sdk_token('simulated')
+            cli.do_set_gid(gid)
+            cli.use_binary = binary
+        sender.fec_parity = parity
+        gateway.pipe_file = None
+        gateway.receive_dir = receive_dir
+
+        def run():
+            for filename in files:
+                path = os.path.join(receive_dir, filename)
+                if os.path.exists(path):
+                    os.remove(path)
+            sender.broadcast_message_files(send_dir, files)
+            deadline = time() + 600
+            while not all(os.path.exists(os.path.join(receive_dir, f)) for f in files):
+                if time() > deadline:
+                    raise RuntimeError("Timed out waiting for {} to be received".format(name))
+                sleep(0.001)
+            for filename in files:
+                if file_digest(os.path.join(receive_dir, filename)) != digests[filename]:
+                    raise RuntimeError("{} received for {} differs from the file sent".format(filename, name))
+            ## and for the repeated head segments sent after the last data segment
+            sender.tx_scheduler.join()
+            return (len(files), total)
+
+        def cleanup():
+            shutil.rmtree(send_dir, ignore_errors=True)
+            shutil.rmtree(receive_dir, ignore_errors=True)
+        run.cleanup = cleanup
+        return ({'files': len(files), 'bytes': total, 'binary': binary, 'fec_parity': parity}, run)
+    setup.__name__ = name
+    return benchmark(setup)
+
+mesh_loop_benchmark('broadcast_to_receive_json', [4096, 65536, 262144], False, 0)
+mesh_loop_benchmark('broadcast_to_receive_binary_fec', [4096, 65536, 262144], True, 4)
+
+def run_benchmark(setup, repeat, quick, seed):
+    rng = random.Random(seed)
+    (params, run) = setup(rng, quick)
+    try:
+        ## once to warm up caches and lazily started threads
+        run()
+        times = []
+        for _ in range(repeat):
+            start = time()
+            (ops, processed) = run()
+            times.append(time() - start)
+    finally:
+        if hasattr(run, 'cleanup'):
+            run.cleanup()
+    times.sort()
+    best = times[0]
+    return {
+        'name': setup.__name__,
+        'params': params,
+        'repeat': repeat,
+        'ops': ops,
+        'bytes': processed,
+        'times': times,
+        'min': best,
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+        'ops_per_sec': ops / best if best else None,
+        'bytes_per_sec': processed / best if best else None
+    }
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path, threshold):
+    """ Print the change of each benchmark from the baseline results, returning the names of those slower by threshold
+    """
+    with open(baseline_path) as f:
+        baseline = dict((r['name'], r) for r in json.load(f)['results'])
+    regressions = []
+    print("{:<36} {:>12} {:>12} {:>8}".format('benchmark', 'baseline', 'current', 'change'), file=sys.stderr)
+    for result in results:
+        before = baseline.get(result['name'])
+        if before is None or before['params'] != result['params']:
+            print("{:<36} {:>12} {:>12.6f} {:>8}".format(result['name'], '-', result['min'], 'new'), file=sys.stderr)
+            continue
+        change = result['min'] / before['min'] - 1 if before['min'] else 0.0
+        print("{:<36} {:>12.6f} {:>12.6f} {:>+7.1f}%".format(result['name'], before['min'], result['min'], 100 * change),
+              file=sys.stderr)
+        if change > threshold:
+            regressions.append(result['name'])
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark txtenna-python')
+    parser.add_argument("--output", default='-',
+                        help="Write the results as JSON to this file (default: standard output)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Timed runs of each benchmark, the fastest is reported (default: 5)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed of the generated inputs (default: 1)")
+    parser.add_argument("--quick", action="store_true",
+                        help="Use smaller inputs, eg. to check the benchmarks run")
+    parser.add_argument("--only", action="append",
+                        help="Only run benchmarks whose name contains this, may be repeated")
+    parser.add_argument("--compare",
+                        help="Compare with the results of an earlier run in this file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="With --compare, exit with status 1 if a benchmark is slower by more than this fraction " +
+                        "(default: 0.2)")
+    args = parser.parse_args()
+
+    results = []
+    with quiet() as stdout:
+        for setup in BENCHMARKS:
+            if args.only and not any(s in setup.__name__ for s in args.only):
+                continue
+            print("Running " + setup.__name__, file=sys.stderr)
+            results.append(run_benchmark(setup, args.repeat, args.quick, args.seed))
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': int(time()),
+            'seed': args.seed,
+            'quick': args.quick
+        },
+        'results': results
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(text, file=stdout)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    if args.compare is not None:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print("Slower than " + args.compare + ": " + ", ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Persistent index of the files broadcast from send_dir
+
+Each file broadcast is recorded with its size, modification time and SHA-256
+content hash, one JSON line per broadcast, so a restart does not broadcast the
+whole directory again. A file whose size and modification time are unchanged is
+skipped without being read; one that was touched but has the same content is
+skipped once its hash has been checked. The index is rewritten, keeping only
+the latest entry of each file, when it is loaded.
+'''
+
+import hashlib
+import json
+import os
+import threading
+import traceback
+
+## kept in send_dir by default, hidden so it is not itself broadcast
+BROADCAST_INDEX_NAME = '.txtenna-broadcast-index'
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class BroadcastIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self.__entries = {}
+        self.__lock = threading.Lock()
+        self.__load()
+        self.__file = open(self.path, 'a')
+
+    def check(self, filename, path):
+        """ Entry to record once path has been broadcast, or None if it was already broadcast as it is
+        """
+        st = os.stat(path)
+        entry = {'f': filename, 's': st.st_size, 'm': st.st_mtime}
+        with self.__lock:
+            known = self.__entries.get(filename)
+        if known is not None and known['s'] == entry['s'] and known['m'] == entry['m']:
+            return None
+
+        entry['h'] = file_hash(path)
+        if known is not None and known['s'] == entry['s'] and known['h'] == entry['h']:
+            ## touched but unchanged, remember the new mtime to skip hashing it next time
+            self.add(entry)
+            return None
+        return entry
+
+    def add(self, entry):
+        """ Record entry, as returned by check, once its file has been broadcast
+        """
+        with self.__lock:
+            self.__entries[entry['f']] = entry
+            self.__file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.__file.flush()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def __load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    ## torn by a crash
+                    break
+                try:
+                    entry = json.loads(line)
+                    self.__entries[entry['f']] = entry
+                except Exception: # pylint: disable=broad-except
+                    traceback.print_exc()
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self.__entries.values():
+                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
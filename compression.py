@@ -0,0 +1,105 @@
+'''
+Compression of message data sent over the mesh
+
+Each file is compressed with every codec available and sent with whichever
+result is smallest, its codec named in the head segment. Data that does not
+compress, eg. an encrypted PGP message, is sent as it is with the "none" codec
+rather than growing by the zlib header. Message data sent without a codec was
+compressed with zlib.
+
+lzma is not in the Python 2 standard library; it is used if the backports.lzma
+package is installed.
+'''
+
+import bz2
+import tempfile
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+CODEC_NONE = 'n'
+CODEC_ZLIB = 'z'
+CODEC_BZ2 = 'b'
+CODEC_LZMA = 'x'
+
+## codec of message data whose head segment does not name one
+DEFAULT_CODEC = CODEC_ZLIB
+
+## compressed data larger than this is spooled to disk by compress_file
+SPOOL_MAX_SIZE = 1024 * 1024
+
+class _Uncompressed:
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+## (decompressor, compressor) of each available codec, in order of preference when results are the same size
+CODECS = [
+    (CODEC_NONE, (_Uncompressed, _Uncompressed)),
+    (CODEC_ZLIB, (zlib.decompressobj, lambda: zlib.compressobj(9))),
+    (CODEC_BZ2, (bz2.BZ2Decompressor, lambda: bz2.BZ2Compressor(9))),
+]
+if lzma is not None:
+    CODECS.append((CODEC_LZMA, (lzma.LZMADecompressor, lambda: lzma.LZMACompressor(preset=9 | lzma.PRESET_EXTREME))))
+
+def compress_file(f, chunk_size=64 * 1024):
+    """ (codec, compressed, size) of the codec that compresses the data read from f the most
+
+    f is read once, a chunk at a time, and compressed with every codec together.
+    compressed is a temporary file of size bytes, positioned at its start, only
+    kept in memory if no larger than SPOOL_MAX_SIZE.
+    """
+    outputs = [(codec, functions[1](), tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE))
+               for (codec, functions) in CODECS]
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        for (_, compressor, spool) in outputs:
+            spool.write(compressor.compress(chunk))
+    for (_, compressor, spool) in outputs:
+        spool.write(compressor.flush())
+
+    best = None
+    for (codec, _, spool) in outputs:
+        if best is None or spool.tell() < best[1].tell():
+            best = (codec, spool)
+    for (_, _, spool) in outputs:
+        if spool is not best[1]:
+            spool.close()
+    (codec, spool) = best
+    size = spool.tell()
+    spool.seek(0)
+    return (codec, spool, size)
+
+def _codec(codec):
+    for (name, functions) in CODECS:
+        if name == (codec or DEFAULT_CODEC):
+            return functions
+    raise ValueError("Unsupported compression codec {}".format(codec))
+
+class Decompressor:
+    """ Decompresses data compressed with codec, or with the default codec if None, a part at a time
+    """
+    def __init__(self, codec):
+        self.__decompressor = _codec(codec)[0]()
+
+    def decompress(self, data):
+        """ As much of the data decompressed as data and the parts before it allow
+        """
+        return self.__decompressor.decompress(data)
+
+    def flush(self):
+        """ The rest of the data, once all of it has been passed to decompress
+        """
+        if hasattr(self.__decompressor, 'flush'):
+            return self.__decompressor.flush()
+        return ''
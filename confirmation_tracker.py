@@ -0,0 +1,131 @@
+'''
+Tracks transactions sent to the local bitcoind until they are confirmed
+
+A single thread subscribes to the zmqpubhashblock and zmqpubrawtx notifications
+of bitcoind. Each new block is fetched once and checked against every pending
+transaction. Pending transactions are polled instead when no notification has
+been received for poll_interval seconds, eg. if notifications are not configured,
+with one batched RPC request for all of them.
+'''
+
+import traceback
+from threading import Thread
+from time import time, sleep
+import Queue
+
+import zmq
+from bitcoin.core import lx, b2x, b2lx, CTransaction
+
+class ConfirmationTracker:
+
+    def __init__(self, reply_func, rpc, zmq_url='tcp://127.0.0.1:28332', timeout=3600, poll_interval=60):
+        """ reply_func(sender_gid, tx_hash, confirmations) is called with 0 confirmations once a
+        transaction is in the mempool, and again once it has been mined. Calls to bitcoind go
+        through rpc, an RPCPool.
+        """
+        self.reply_func = reply_func
+        self.rpc = rpc
+        self.zmq_url = zmq_url
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.__pending = {}
+        self.__requests = Queue.Queue()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def track(self, tx_hash, sender_gid):
+        """ Report the confirmation of tx_hash to sender_gid
+        """
+        self.__requests.put((tx_hash, sender_gid))
+
+    def pending(self):
+        return len(self.__pending)
+
+    def __run(self):
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b'hashblock')
+        socket.setsockopt(zmq.SUBSCRIBE, b'rawtx')
+        socket.connect(self.zmq_url)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        last_poll = time()
+        last_notification = time()
+
+        while True:
+            try:
+                added = []
+                while not self.__requests.empty():
+                    (tx_hash, sender_gid) = self.__requests.get()
+                    self.__add(tx_hash, sender_gid)
+                    if tx_hash not in added:
+                        added.append(tx_hash)
+                if added:
+                    self.__check(added)
+
+                if poller.poll(1000):
+                    parts = socket.recv_multipart()
+                    last_notification = time()
+                    if parts[0] == b'hashblock':
+                        ## notifications carry the block hash in RPC byte order
+                        self.__block(lx(b2x(parts[1])))
+                    elif parts[0] == b'rawtx':
+                        self.__mempool(CTransaction.deserialize(parts[1]))
+
+                if time() - last_poll >= self.poll_interval:
+                    last_poll = time()
+                    self.__poll(time() - last_notification >= self.poll_interval)
+            except Exception: # pylint: disable=broad-except
+                ## unknown RPC error, but keep trying; the pool replaces broken connections
+                traceback.print_exc()
+                sleep(1)
+
+    def __add(self, tx_hash, sender_gid):
+        entry = self.__pending.setdefault(tx_hash, {'gids': [], 'mempool': False, 'added': time()})
+        if sender_gid not in entry['gids']:
+            entry['gids'].append(sender_gid)
+
+    def __check(self, tx_hashes):
+        for (tx_hash, r) in self.rpc.getrawtransactions(tx_hashes).items():
+            if r is None:
+                ## tx_id not yet in the mempool
+                continue
+            self.__mempool_hash(tx_hash)
+            confirmations = r.get('confirmations', 0)
+            if confirmations > 0:
+                self.__confirmed(tx_hash, confirmations)
+
+    def __mempool(self, tx):
+        self.__mempool_hash(b2lx(tx.GetTxid()))
+
+    def __mempool_hash(self, tx_hash):
+        entry = self.__pending.get(tx_hash)
+        if entry is not None and not entry['mempool']:
+            entry['mempool'] = True
+            for sender_gid in entry['gids']:
+                self.reply_func(sender_gid, tx_hash, 0)
+
+    def __block(self, block_hash):
+        if not self.__pending:
+            return
+        with self.rpc.proxy() as proxy:
+            block = proxy.getblock(block_hash)
+        for tx in block.vtx:
+            tx_hash = b2lx(tx.GetTxid())
+            if tx_hash in self.__pending:
+                self.__mempool_hash(tx_hash)
+                self.__confirmed(tx_hash, 1)
+
+    def __poll(self, check):
+        if check and self.__pending:
+            self.__check(list(self.__pending))
+        for tx_hash in list(self.__pending):
+            entry = self.__pending.get(tx_hash)
+            if entry is not None and time() - entry['added'] > self.timeout:
+                del self.__pending[tx_hash]
+                print("\nTransaction " + tx_hash + " not confirmed after " + str(self.timeout // 60) + " minutes.")
+
+    def __confirmed(self, tx_hash, confirmations):
+        entry = self.__pending.pop(tx_hash)
+        for sender_gid in entry['gids']:
+            self.reply_func(sender_gid, tx_hash, confirmations)
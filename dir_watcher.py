@@ -0,0 +1,176 @@
+'''
+Watches a directory for files that have been completely written
+
+On Linux, inotify reports a file once the program writing it closes it, or once
+it is renamed into the directory, so files are never picked up half written.
+Elsewhere, or if inotify is not available, the directory is polled and a file
+is reported once its size and modification time have stopped changing.
+
+Files already in the directory are reported when watching starts, in batches so
+a large directory is processed a part at a time. Hidden files, eg. temporary files
+renamed into place once written, are ignored.
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import traceback
+from time import time, sleep
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+## wd, mask, cookie, len, followed by len bytes of NUL padded name
+INOTIFY_EVENT_FORMAT = 'iIII'
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return (libc.inotify_init1, libc.inotify_add_watch)
+    except (OSError, AttributeError):
+        return None
+
+class DirectoryWatcher:
+
+    def __init__(self, path, callback, poll_interval=10, settle_time=2, batch_size=100, use_inotify=True):
+        """ callback(path, filenames) is called with the names of completed files
+        """
+        self.path = path
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.batch_size = batch_size
+        self.use_inotify = use_inotify
+        ## names reported, with their size and modification time when polling
+        self.__reported = {}
+        ## files found by a scan that may still be being written
+        self.__deferred = set()
+
+    def run(self):
+        """ Watch until the directory is removed
+        """
+        fd = self.__inotify() if self.use_inotify else None
+        if fd is None:
+            self.__poll()
+            return
+        try:
+            self.__scan(os.listdir(self.path))
+            self.__watch(fd)
+        finally:
+            os.close(fd)
+
+    def __report(self, filenames):
+        for start in range(0, len(filenames), self.batch_size):
+            batch = filenames[start:start + self.batch_size]
+            for f in batch:
+                self.__reported.setdefault(f, None)
+            try:
+                self.callback(self.path, batch)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+
+    def __scan(self, filenames):
+        """ Report those of filenames not already reported, eg. files present before watching started
+
+        Files modified within settle_time are deferred until they have settled, in case
+        they were closed before the watch started.
+        """
+        completed = []
+        now = time()
+        for f in sorted(filenames):
+            path = os.path.join(self.path, f)
+            if f in self.__reported or f.startswith('.') or not os.path.isfile(path):
+                self.__deferred.discard(f)
+                continue
+            if now - os.path.getmtime(path) < self.settle_time:
+                self.__deferred.add(f)
+            else:
+                self.__deferred.discard(f)
+                completed.append(f)
+        self.__report(completed)
+
+    def __inotify(self):
+        functions = _load_inotify()
+        if functions is None:
+            print("inotify is not available, polling " + self.path)
+            return None
+        (inotify_init1, inotify_add_watch) = functions
+        fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            print("inotify_init1 failed, polling " + self.path + ": " + os.strerror(ctypes.get_errno()))
+            return None
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF
+        if inotify_add_watch(fd, self.path, mask) < 0:
+            print("inotify_add_watch failed, polling " + self.path + ": " + os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return None
+        return fd
+
+    def __watch(self, fd):
+        header_len = struct.calcsize(INOTIFY_EVENT_FORMAT)
+        while True:
+            if not select.select([fd], [], [], self.settle_time if self.__deferred else None)[0]:
+                self.__scan(list(self.__deferred))
+                continue
+            try:
+                data = os.read(fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+
+            completed = []
+            offset = 0
+            while offset < len(data):
+                (_, mask, _, name_len) = struct.unpack_from(INOTIFY_EVENT_FORMAT, data, offset)
+                name = data[offset + header_len:offset + header_len + name_len].rstrip('\0')
+                offset += header_len + name_len
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    ## the directory itself is gone
+                    self.__report(completed)
+                    return
+                if mask & IN_Q_OVERFLOW:
+                    print("Too many changes to " + self.path + ", scanning it again")
+                    self.__scan(os.listdir(self.path))
+                elif (mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and not mask & IN_ISDIR
+                      and not name.startswith('.') and name not in completed):
+                    completed.append(name)
+            self.__report(completed)
+
+    def __poll(self):
+        """ Report files once their size and modification time are unchanged for settle_time
+        """
+        previous = None
+        while os.path.exists(self.path):
+            now = time()
+            current = {}
+            for f in os.listdir(self.path):
+                if f.startswith('.'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.path, f))
+                except OSError:
+                    continue
+                if os.path.isfile(os.path.join(self.path, f)):
+                    current[f] = (st.st_size, st.st_mtime)
+
+            ## files unchanged since the last poll, or old enough at the first, and not reported as they are
+            completed = sorted(f for (f, state) in current.items()
+                               if now - state[1] >= self.settle_time
+                               and (previous is None or previous.get(f) == state)
+                               and self.__reported.get(f) != state)
+            for f in completed:
+                self.__reported[f] = current[f]
+            self.__report(completed)
+            previous = current
+            sleep(self.poll_interval)
@@ -0,0 +1,151 @@
+'''
+Reed-Solomon erasure code for segment payloads
+
+Data blocks are coded in groups of up to FEC_GROUP blocks, each group followed
+by its own parity blocks computed with a Cauchy matrix over GF(256). Any blocks
+of a group that were lost can be recovered from as many parity blocks of that
+group. Blocks shorter than the parity blocks are coded as if padded with zero
+bytes.
+
+Multiplying a block by a constant is a str.translate() with a precomputed table,
+and adding blocks is an XOR of them as long integers.
+'''
+
+import binascii
+
+FEC_GROUP = 64
+MAX_PARITY = 128
+
+## GF(256) with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+_EXP = [0] * 512
+_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    _EXP[_i] = _x
+    _LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    _EXP[_i] = _EXP[_i - 255]
+
+def _mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+def _inv(a):
+    return _EXP[255 - _LOG[a]]
+
+_MUL_TABLES = [''.join(chr(_mul(c, v)) for v in range(256)) for c in range(256)]
+
+def _coefficient(row, col):
+    """ Cauchy matrix entry for parity row and data column of a group
+    """
+    return _inv((FEC_GROUP + row) ^ col)
+
+def _to_int(block, length):
+    return int(binascii.hexlify(block.ljust(length, '\0')), 16) if block else 0
+
+def _from_int(value, length):
+    if length == 0:
+        return ''
+    return binascii.unhexlify('%0*x' % (2 * length, value))
+
+def _combine(terms, length):
+    """ Sum of coefficient * block for (coefficient, block) in terms
+    """
+    acc = 0
+    for (c, block) in terms:
+        if c:
+            acc ^= _to_int(block.translate(_MUL_TABLES[c]), length)
+    return acc
+
+def _groups(count):
+    return [range(start, min(start + FEC_GROUP, count)) for start in range(0, count, FEC_GROUP)]
+
+def parity_count(count, parity):
+    """ Number of parity blocks encode returns for count blocks
+    """
+    return len(_groups(count)) * parity
+
+def group_sizes(count):
+    """ Number of blocks in each group of count blocks
+    """
+    return [len(group) for group in _groups(count)]
+
+def encode(blocks, parity, length=None):
+    """ Parity blocks for blocks, parity for each group of up to FEC_GROUP blocks
+
+    The parity blocks are length bytes long, by default as long as the longest
+    data block. Groups encoded separately must use the same length.
+    """
+    if not 0 < parity <= MAX_PARITY:
+        raise ValueError("parity must be between 1 and {}".format(MAX_PARITY))
+    if length is None:
+        length = max(len(block) for block in blocks)
+    ret = []
+    for group in _groups(len(blocks)):
+        for row in range(parity):
+            terms = [(_coefficient(row, col), blocks[i]) for (col, i) in enumerate(group)]
+            ret.append(_from_int(_combine(terms, length), length))
+    return ret
+
+def decode(blocks, parities, parity):
+    """ Recover the missing (None) entries of blocks, in place, from parities
+
+    parities maps the index of each parity block received, in the order returned
+    by encode, to its bytes. Recovered blocks are as long as the parity blocks.
+    Returns the indexes of the blocks recovered.
+    """
+    recovered = []
+    for (g, group) in enumerate(_groups(len(blocks))):
+        group_blocks = [blocks[i] for i in group]
+        group_parities = dict((idx - g * parity, block) for (idx, block) in parities.items()
+                              if g * parity <= idx < (g + 1) * parity)
+        for col in decode_group(group_blocks, group_parities):
+            blocks[group[col]] = group_blocks[col]
+            recovered.append(group[col])
+    return recovered
+
+def decode_group(blocks, parities):
+    """ Recover the missing (None) entries of the blocks of one group, in place
+
+    parities maps the row of each parity block received for the group to its
+    bytes. Nothing is recovered unless there are at least as many parity blocks
+    as missing blocks. Returns the positions in blocks of the blocks recovered.
+    """
+    missing = [col for col in range(len(blocks)) if blocks[col] is None]
+    rows = sorted(parities)
+    if not missing or len(rows) < len(missing):
+        return []
+    rows = rows[:len(missing)]
+    length = len(parities[rows[0]])
+
+    ## parity minus the contribution of the blocks received
+    syndromes = []
+    for row in rows:
+        terms = [(_coefficient(row, col), block) for (col, block) in enumerate(blocks) if block is not None]
+        syndromes.append(_from_int(_to_int(parities[row], length) ^ _combine(terms, length), length))
+
+    inverse = _invert([[_coefficient(row, col) for col in missing] for row in rows])
+    for (m, col) in enumerate(missing):
+        terms = [(inverse[m][r], syndromes[r]) for r in range(len(rows))]
+        blocks[col] = _from_int(_combine(terms, length), length)
+    return missing
+
+def _invert(matrix):
+    """ Inverse of a square matrix over GF(256) by Gauss-Jordan elimination
+    """
+    n = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(n)] for (i, row) in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if rows[r][col])
+        (rows[col], rows[pivot]) = (rows[pivot], rows[col])
+        scale = _inv(rows[col][col])
+        rows[col] = [_mul(scale, v) for v in rows[col]]
+        for r in range(n):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [v ^ _mul(factor, p) for (v, p) in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
@@ -0,0 +1,102 @@
+'''
+Bounded queue of received messages handled by a pool of worker threads
+
+The goTenna SDK delivers messages on its API thread, which cannot deliver
+further events while a message is being handled. Messages are queued here
+instead and handled by the workers, so slow handling (eg. HTTP requests to
+txtenna-server) does not hold up the radio.
+'''
+
+import traceback
+from collections import deque
+from threading import Thread, Condition, Lock
+from time import time
+
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = [OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK]
+
+class IngestQueue:
+
+    def __init__(self, handler, workers=2, max_depth=1000, overflow=OVERFLOW_DROP_NEWEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        self.handler = handler
+        self.workers = workers
+        self.max_depth = max_depth
+        self.overflow = overflow
+        self.queued = 0
+        self.started = 0
+        self.handled = 0
+        self.dropped = 0
+        self.peak_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.__items = deque()
+        self.__condition = Condition()
+        self.__start_lock = Lock()
+        self.__threads = []
+
+    def put(self, item):
+        """ Queue item to be handled, returning False if it was dropped
+        """
+        self.__start()
+        with self.__condition:
+            while len(self.__items) >= self.max_depth:
+                if self.overflow == OVERFLOW_BLOCK:
+                    self.__condition.wait()
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    self.__items.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return False
+            self.__items.append((time(), item))
+            self.queued += 1
+            self.peak_depth = max(self.peak_depth, len(self.__items))
+            self.__condition.notify_all()
+            return True
+
+    def depth(self):
+        with self.__condition:
+            return len(self.__items)
+
+    def stats(self):
+        with self.__condition:
+            return {
+                'depth': len(self.__items),
+                'peak_depth': self.peak_depth,
+                'queued': self.queued,
+                'handled': self.handled,
+                'dropped': self.dropped,
+                'average_latency': self.total_latency / self.started if self.started else 0.0,
+                'max_latency': self.max_latency
+            }
+
+    def __start(self):
+        with self.__start_lock:
+            while len(self.__threads) < self.workers:
+                t = Thread(target=self.__run)
+                t.daemon = True
+                t.start()
+                self.__threads.append(t)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__items:
+                    self.__condition.wait()
+                (queued_at, item) = self.__items.popleft()
+                ## wake a producer blocked on a full queue
+                self.__condition.notify_all()
+                latency = time() - queued_at
+                self.started += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            try:
+                self.handler(item)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+            with self.__condition:
+                self.handled += 1
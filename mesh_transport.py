@@ -0,0 +1,244 @@
+'''
+Radio transports used by txtenna.py
+
+A transport is any object that offers the subset of the goTenna SDK driver
+(goTenna.driver.Driver) interface used by goTennaCLI: start, join, connected,
+gid, device_type, system_info, set_gid, set_rf_settings, set_geo_settings,
+send_broadcast and send_private. Events are delivered to the event_callback
+passed at creation.
+
+The SimulatedMesh connects several transports in one process so the relay can
+be exercised and measured without goTenna radios. Like the SDK, it carries
+arbitrary bytes only in binary payloads: a text payload must be UTF-8 text.
+'''
+
+import heapq
+import random
+import threading
+import traceback
+import uuid
+from time import time
+import Queue
+
+import goTenna # The goTenna API
+
+def payload_data(payload):
+    """ Bytes carried by a text or binary SDK payload
+
+    Raises ValueError for text that is not UTF-8 without NUL characters, which
+    only a binary payload can carry.
+    """
+    binary_data = getattr(payload, 'binary_data', None)
+    if binary_data is not None:
+        return str(binary_data)
+    message = payload.message
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    else:
+        message.decode('utf-8')
+    if '\0' in message:
+        raise ValueError("Text payload contains a NUL character")
+    return message
+
+class SimulatedMessage(object):
+    """ Received message in the shape delivered by the SDK with Event.MESSAGE
+    """
+    def __init__(self, sender, destination, payload):
+        self.sender = sender
+        self.destination = destination
+        self.payload = payload
+
+    def __str__(self):
+        return "Message from {}: {!r}".format(self.sender.gid_val, payload_data(self.payload))
+
+class SimulatedEvent(object):
+    """ Event in the shape delivered by the SDK to the event_callback
+    """
+    def __init__(self, event_type, message=None, status=None):
+        self.event_type = event_type
+        self.message = message
+        self.status = status
+
+    def __str__(self):
+        if self.message is not None:
+            return str(self.message)
+        return "Simulated event {}".format(self.event_type)
+
+class SimulatedMesh(object):
+    """ A shared radio channel connecting SimulatedTransport instances
+
+    Frames are sent one at a time on the channel. Each frame occupies the
+    channel for frame_overhead + 8 * len(message) / bitrate seconds and is
+    heard by each other node after a further latency seconds, unless it is
+    lost with probability loss.
+    """
+    def __init__(self, bitrate=9600, frame_overhead=0.1, latency=0.05, loss=0.0, seed=None):
+        self.bitrate = bitrate
+        self.frame_overhead = frame_overhead
+        self.latency = latency
+        self.loss = loss
+        self._random = random.Random(seed)
+        self._transports = []
+        self._lock = threading.Condition()
+        self._pending = []
+        self._sequence = 0
+        self._channel_free_at = 0.0
+        self.frames_sent = 0
+        self.frames_delivered = 0
+        self.frames_lost = 0
+        self.bytes_sent = 0
+        self.airtime = 0.0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def transport_factory(self, sdk_token, event_callback):
+        """ Create a transport on this mesh, for use as goTennaCLI(transport_factory=...)
+        """
+        transport = SimulatedTransport(self, event_callback)
+        with self._lock:
+            self._transports.append(transport)
+        return transport
+
+    def frame_airtime(self, message):
+        """ Seconds of channel time needed to send message in one frame
+        """
+        airtime = self.frame_overhead
+        if self.bitrate:
+            airtime += 8.0 * len(message) / self.bitrate
+        return airtime
+
+    def stats(self):
+        return {
+            'frames_sent': self.frames_sent,
+            'frames_delivered': self.frames_delivered,
+            'frames_lost': self.frames_lost,
+            'bytes_sent': self.bytes_sent,
+            'airtime': self.airtime
+        }
+
+    def transmit(self, sender, payload, method_callback, corr_id, destination=None, ack_callback=None):
+        """ Queue a frame from sender, to every other node or only to destination
+        """
+        message = payload_data(payload)
+        with self._lock:
+            airtime = self.frame_airtime(message)
+            start = max(time(), self._channel_free_at)
+            sent_at = start + airtime
+            self._channel_free_at = sent_at
+            self.frames_sent += 1
+            self.bytes_sent += len(message)
+            self.airtime += airtime
+
+            msg = SimulatedMessage(sender.gid, destination, payload)
+            delivered = False
+            for transport in self._transports:
+                if transport is sender or not transport.connected:
+                    continue
+                if destination is not None and transport.gid.gid_val != destination.gid_val:
+                    continue
+                if self._random.random() < self.loss:
+                    self.frames_lost += 1
+                    continue
+                delivered = True
+                self.frames_delivered += 1
+                self._schedule(sent_at + self.latency, transport.deliver, msg)
+
+            self._schedule(sent_at, sender.call, method_callback, corr_id, True)
+            if ack_callback is not None:
+                self._schedule(sent_at + 2 * self.latency, sender.call, ack_callback, corr_id, delivered)
+
+    def _schedule(self, when, func, *args):
+        heapq.heappush(self._pending, (when, self._sequence, func, args))
+        self._sequence += 1
+        self._lock.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending or self._pending[0][0] > time():
+                    if self._pending:
+                        self._lock.wait(self._pending[0][0] - time())
+                    else:
+                        self._lock.wait()
+                (_, _, func, args) = heapq.heappop(self._pending)
+            func(*args)
+
+class SimulatedTransport(threading.Thread):
+    """ A simulated goTenna radio attached to a SimulatedMesh
+
+    Like the SDK driver, events are delivered to event_callback from this
+    transport's own thread. The radio connects once started and given a GID.
+    """
+    def __init__(self, mesh, event_callback):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.mesh = mesh
+        self.event_callback = event_callback
+        self.gid = None
+        self.rf_settings = None
+        self.geo_settings = None
+        self.device_type = "mesh"
+        self.system_info = {'serial': 'SIMULATED', 'firmware_version': (1, 1, 12)}
+        self._started = False
+        self._events = Queue.Queue()
+
+    @property
+    def connected(self):
+        return self._started and self.gid is not None
+
+    def set_gid(self, gid):
+        was_connected = self.connected
+        self.gid = gid
+        if self.connected and not was_connected:
+            self.call(self.event_callback, SimulatedEvent(goTenna.driver.Event.CONNECT))
+
+    def set_rf_settings(self, rf_settings):
+        self.rf_settings = rf_settings
+
+    def set_geo_settings(self, geo_settings):
+        self.geo_settings = geo_settings
+
+    def send_broadcast(self, payload, method_callback):
+        if not self.connected:
+            return None
+        corr_id = uuid.uuid4()
+        self.mesh.transmit(self, payload, method_callback, corr_id)
+        return corr_id
+
+    def send_private(self, gid, payload, method_callback, ack_callback=None, encrypt=True):
+        # pylint: disable=unused-argument
+        if not self.connected:
+            return None
+        corr_id = uuid.uuid4()
+        self.mesh.transmit(self, payload, method_callback, corr_id, destination=gid, ack_callback=ack_callback)
+        return corr_id
+
+    def deliver(self, message):
+        self.call(self.event_callback, SimulatedEvent(goTenna.driver.Event.MESSAGE, message=message))
+
+    def call(self, func, *args):
+        """ Run func(*args) on this transport's thread, like SDK callbacks
+        """
+        self._events.put((func, args))
+
+    def start(self):
+        self._started = True
+        threading.Thread.start(self)
+        if self.connected:
+            self.call(self.event_callback, SimulatedEvent(goTenna.driver.Event.CONNECT))
+
+    def join(self, timeout=None):
+        self._events.put(None)
+        threading.Thread.join(self, timeout)
+
+    def run(self):
+        while True:
+            item = self._events.get()
+            if item is None:
+                break
+            (func, args) = item
+            try:
+                func(*args)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
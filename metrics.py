@@ -0,0 +1,219 @@
+'''
+Counters, gauges and histograms of the relay pipeline
+
+Each module creates the metrics it records in the shared REGISTRY, eg.
+
+    RPC_SECONDS = metrics.histogram('txtenna_rpc_seconds', 'bitcoind JSON-RPC request latency')
+    with RPC_SECONDS.time():
+        ...
+
+The stats command prints them, and they can be exported in the Prometheus text
+format from a local HTTP endpoint or to a file read by the node_exporter
+textfile collector.
+'''
+
+import os
+import threading
+import traceback
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from time import time, sleep
+
+## upper bounds of the buckets of latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+## upper bounds of the buckets of size histograms, in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+class Gauge:
+    """ A value that is set, or read from func when collected
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, func=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.value
+        if self.func is not None:
+            try:
+                value = self.func()
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+        return [(self.name, value)]
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.__lock = threading.Lock()
+
+    def observe(self, value):
+        with self.__lock:
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    @contextmanager
+    def time(self):
+        """ Observe the time taken by a with block
+        """
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start)
+
+    def quantile(self, q):
+        """ Estimate of the q quantile, the upper bound of the bucket it falls in
+        """
+        with self.__lock:
+            if not self.count:
+                return 0
+            rank = q * self.count
+            seen = 0
+            for (bound, count) in zip(self.buckets, self.counts):
+                seen += count
+                if seen >= rank:
+                    return min(bound, self.max)
+            return self.max
+
+    def samples(self):
+        with self.__lock:
+            ret = []
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, self.counts):
+                cumulative += count
+                ret.append(('{}_bucket{{le="{}"}}'.format(self.name, _format(bound)), cumulative))
+            ret.append((self.name + '_sum', self.sum))
+            ret.append((self.name + '_count', self.count))
+            return ret
+
+class Registry:
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        return self.__register(Counter, name, help_text)
+
+    def gauge(self, name, help_text, func=None):
+        """ Gauge name, reading its value from func if given
+        """
+        gauge = self.__register(Gauge, name, help_text)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self.__register(Histogram, name, help_text, buckets)
+
+    def collect(self):
+        """ The metrics registered, ordered by name
+        """
+        with self.__lock:
+            return [self.__metrics[name] for name in sorted(self.__metrics)]
+
+    def render(self):
+        """ The metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.collect():
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for (name, value) in metric.samples():
+                lines.append('{} {}'.format(name, _format(value)))
+        return '\n'.join(lines) + '\n'
+
+    def __register(self, cls, name, *args):
+        with self.__lock:
+            if name not in self.__metrics:
+                self.__metrics[name] = cls(name, *args)
+            return self.__metrics[name]
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY):
+    """ Serve the metrics to Prometheus at http://host:port/metrics from a background thread
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def start_file_writer(path, interval=15, registry=REGISTRY):
+    """ Write the metrics to path every interval seconds from a background thread
+
+    The file is replaced atomically, as the node_exporter textfile collector expects.
+    """
+    def run():
+        while True:
+            try:
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.write(registry.render())
+                os.rename(tmp_path, path)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+            sleep(interval)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,186 @@
+'''
+Selective retransmission of lost segments
+
+A receiver that has heard nothing new for an incomplete payload after a gap
+timeout sends its originator a NACK, a private message listing the sequence
+numbers still missing, eg. {"i":"a81e42cd87e7311e","m":"0,3,5-7"}. The
+originator keeps the segments it recently broadcast and broadcasts again only
+the ones listed.
+'''
+
+import json
+import threading
+import traceback
+from collections import OrderedDict
+from time import time, sleep
+
+## characters allowed for the list of missing sequence numbers in one NACK
+NACK_MAX_RANGES_LEN = 150
+
+def serialize_nack(payload_id, missing):
+    """ NACK listing the sequence numbers in missing, as many as fit in one message
+    """
+    ranges = []
+    length = 0
+    for (first, last) in _ranges(sorted(missing)):
+        text = str(first) if first == last else "{}-{}".format(first, last)
+        length += len(text) + 1
+        if length > NACK_MAX_RANGES_LEN:
+            break
+        ranges.append(text)
+    return json.dumps({"i": payload_id, "m": ",".join(ranges)}, separators=(',', ':'))
+
+def deserialize_nack(message):
+    """ (payload_id, sequence numbers) of a NACK, or None for any other message
+    """
+    if not message.startswith('{') or '"m"' not in message:
+        return None
+    data = json.loads(message)
+    if "i" not in data or "m" not in data:
+        return None
+    missing = []
+    for text in data["m"].split(","):
+        if "-" in text:
+            (first, last) = text.split("-")
+            missing.extend(range(int(first), int(last) + 1))
+        elif text:
+            missing.append(int(text))
+    return (data["i"], missing)
+
+def _ranges(seqs):
+    ranges = []
+    for seq in seqs:
+        if ranges and seq == ranges[-1][1] + 1:
+            ranges[-1][1] = seq
+        else:
+            ranges.append([seq, seq])
+    return ranges
+
+class SentSegmentCache:
+    """ Segments recently broadcast by this node, by payload id and sequence number
+
+    The segments of the least recently started broadcasts are forgotten while
+    there are more than max_payloads or their frames hold more than max_bytes,
+    and the earliest segments of a broadcast too large to keep whole.
+
+    A segment is not resent again within holdoff seconds, so NACKs from several
+    receivers for the same segment cost only one retransmission.
+    """
+    def __init__(self, max_payloads=32, max_bytes=1024*1024, holdoff=10):
+        self.max_payloads = max_payloads
+        self.max_bytes = max_bytes
+        self.holdoff = holdoff
+        self.resent = 0
+        self.__bytes = 0
+        self.__payloads = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def start(self, payload_id, priority):
+        """ Keep the segments of a new broadcast of payload_id, to resend at priority, instead of any earlier ones
+        """
+        with self.__lock:
+            self.__forget(payload_id)
+            self.__payloads[payload_id] = (priority, OrderedDict())
+            while len(self.__payloads) > self.max_payloads:
+                self.__forget(next(iter(self.__payloads)))
+
+    def add(self, payload_id, seq, frame):
+        """ Keep frame, the serialized segment seq of the broadcast started for payload_id
+        """
+        with self.__lock:
+            if payload_id not in self.__payloads:
+                return
+            frames = self.__payloads[payload_id][1]
+            if seq in frames:
+                self.__bytes -= len(frames.pop(seq)[0])
+            frames[seq] = [frame, 0]
+            self.__bytes += len(frame)
+            while self.__bytes > self.max_bytes:
+                oldest = next(iter(self.__payloads))
+                if oldest != payload_id:
+                    self.__forget(oldest)
+                else:
+                    self.__bytes -= len(frames.popitem(last=False)[1][0])
+
+    def stats(self):
+        with self.__lock:
+            return {'payloads': len(self.__payloads), 'bytes': self.__bytes, 'resent': self.resent}
+
+    def __forget(self, payload_id):
+        entry = self.__payloads.pop(payload_id, None)
+        if entry is not None:
+            self.__bytes -= sum(len(frame) for (frame, _) in entry[1].values())
+
+    def get(self, payload_id, seqs):
+        """ (priority, serialized segments) to resend for seqs, or None if payload_id is not cached
+        """
+        with self.__lock:
+            if payload_id not in self.__payloads:
+                return None
+            (priority, frames) = self.__payloads[payload_id]
+            now = time()
+            resend = []
+            for seq in seqs:
+                if seq in frames and now - frames[seq][1] >= self.holdoff:
+                    frames[seq][1] = now
+                    resend.append(frames[seq][0])
+            self.resent += len(resend)
+            return (priority, resend)
+
+class RetransmitRequester:
+    """ Sends NACKs for the incomplete payloads in a SegmentStorage
+
+    send_nack(sender_gid, nack) is called with the serialized NACK after gap_timeout
+    seconds without a new segment for a payload, up to max_rounds times per payload.
+    """
+    def __init__(self, storage, send_nack, gap_timeout=30, max_rounds=5):
+        self.storage = storage
+        self.send_nack = send_nack
+        self.gap_timeout = gap_timeout
+        self.max_rounds = max_rounds
+        self.sent = 0
+        self.__payloads = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def seen(self, payload_id, sender_gid):
+        """ Note a new segment of payload_id from sender_gid
+        """
+        with self.__lock:
+            entry = self.__payloads.setdefault(payload_id, {'rounds': 0})
+            entry['sender'] = sender_gid
+            entry['updated'] = time()
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run)
+                self.__thread.daemon = True
+                self.__thread.start()
+
+    def done(self, payload_id):
+        with self.__lock:
+            self.__payloads.pop(payload_id, None)
+
+    def __run(self):
+        while True:
+            sleep(min(5.0, self.gap_timeout / 2.0))
+            try:
+                self.__check()
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+
+    def __check(self):
+        now = time()
+        with self.__lock:
+            due = [(payload_id, dict(entry)) for (payload_id, entry) in self.__payloads.items()
+                   if now - entry['updated'] >= self.gap_timeout]
+        for (payload_id, entry) in due:
+            missing = self.storage.get_missing(payload_id)
+            if not missing or entry['rounds'] >= self.max_rounds:
+                ## complete, handed off, evicted, or given up on
+                self.done(payload_id)
+                continue
+            self.send_nack(entry['sender'], serialize_nack(payload_id, missing))
+            with self.__lock:
+                if payload_id in self.__payloads:
+                    self.__payloads[payload_id]['rounds'] += 1
+                    self.__payloads[payload_id]['updated'] = time()
+                self.sent += 1
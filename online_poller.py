@@ -0,0 +1,144 @@
+'''
+Polls txtenna-server for the confirmation of relayed transactions
+
+One thread keeps every pending transaction in a schedule ordered by the time of
+its next check, and checks them through a pooled HTTP session. Transactions not
+yet known to the server are checked less often the longer they are missing.
+'''
+
+import heapq
+import json
+import traceback
+from threading import Thread, Condition
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+HTTP_SECONDS = metrics.histogram('txtenna_poller_http_seconds', 'Latency of checking a transaction with the block explorer')
+
+class OnlineConfirmationPoller:
+
+    def __init__(self, reply_func, server='https://api.samourai.io', interval=60, max_interval=600,
+                 timeout=6*3600, request_timeout=10, pool_size=4):
+        """ reply_func(sender_gid, tx_hash, block) is called with block 0 once a transaction
+        is in the mempool, and with the block height once it has been mined
+        """
+        self.reply_func = reply_func
+        self.server = server
+        self.interval = interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.request_timeout = request_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.__pending = {}
+        self.__schedule = []
+        self.__stopped = False
+        self.__condition = Condition()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def url(self, tx_hash, network):
+        if network == 't':
+            return self.server + "/test/v2/tx/" + tx_hash ## default testnet txtenna-server
+        return self.server + "/v2/tx/" + tx_hash ## default txtenna-server
+
+    def track(self, tx_hash, sender_gid, network):
+        """ Report the confirmation of tx_hash to sender_gid
+        """
+        with self.__condition:
+            entry = self.__pending.get(tx_hash)
+            if entry is None:
+                entry = {'gids': [], 'network': network, 'mempool': False,
+                         'added': time(), 'interval': self.interval}
+                self.__pending[tx_hash] = entry
+                heapq.heappush(self.__schedule, (time(), tx_hash))
+                self.__condition.notify()
+            if sender_gid in entry['gids']:
+                return
+            entry['gids'].append(sender_gid)
+            in_mempool = entry['mempool']
+        if in_mempool:
+            ## the other senders were already told
+            self.reply_func(sender_gid, tx_hash, 0)
+
+    def pending(self):
+        with self.__condition:
+            return len(self.__pending)
+
+    def stop(self):
+        """ Stop polling, once any check in progress is done
+        """
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__stopped and (not self.__schedule or self.__schedule[0][0] > time()):
+                    if self.__schedule:
+                        self.__condition.wait(self.__schedule[0][0] - time())
+                    else:
+                        self.__condition.wait()
+                if self.__stopped:
+                    return
+                (_, tx_hash) = heapq.heappop(self.__schedule)
+                entry = self.__pending[tx_hash]
+
+            try:
+                done = self.__check(tx_hash, entry)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+                done = False
+
+            with self.__condition:
+                if not done and time() - entry['added'] > self.timeout:
+                    print("\nTransaction " + tx_hash + " not confirmed after " + str(self.timeout // 3600) + " hours.")
+                    done = True
+                if done:
+                    del self.__pending[tx_hash]
+                else:
+                    heapq.heappush(self.__schedule, (time() + entry['interval'], tx_hash))
+
+    def __check(self, tx_hash, entry):
+        """ Check tx_hash once, returning True once it is confirmed
+        """
+        try:
+            with HTTP_SECONDS.time():
+                r = self.session.get(self.url(tx_hash, entry['network']), timeout=self.request_timeout)
+        except requests.exceptions.RequestException as e:
+            print("Could not check transaction " + tx_hash + ": " + str(e))
+            self.__backoff(entry)
+            return False
+
+        if r.status_code != 200:
+            ## not yet known to the server
+            self.__backoff(entry)
+            return False
+
+        if not entry['mempool']:
+            with self.__condition:
+                entry['mempool'] = True
+                entry['interval'] = self.interval
+                gids = list(entry['gids'])
+            for sender_gid in gids:
+                self.reply_func(sender_gid, tx_hash, 0)
+
+        obj = json.loads(r.text)
+        if 'block' not in obj:
+            return False
+
+        blockheight = obj['block']['height']
+        for sender_gid in entry['gids']:
+            self.reply_func(sender_gid, tx_hash, blockheight)
+        return True
+
+    def __backoff(self, entry):
+        entry['interval'] = min(self.max_interval, entry['interval'] * 2)
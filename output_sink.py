@@ -0,0 +1,207 @@
+'''
+Sinks for the message data received over the mesh
+
+Data for the Blockstream Satellite API pipe is written by a single PipeWriter
+thread, which keeps the pipe open between payloads and opens it again if its
+reader goes away. Completed payloads wait for the writer in a buffer of bounded
+size, so a slow reader holds up the threads handing off payloads rather than
+using more and more memory. Each payload is written as the header returned by
+header_func(length) followed by the data, with a vectored write so they are not
+first joined in memory.
+
+Data for receive_dir is written to a hidden temporary file that is renamed into
+place once complete, so a partly received file is never seen under its name.
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import tempfile
+import threading
+import traceback
+from collections import deque
+from time import sleep
+
+## data is read from spooled payloads and written to the pipe this much at a time
+WRITE_CHUNK = 64 * 1024
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_char_p), ('iov_len', ctypes.c_size_t)]
+
+def _load_writev():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return libc.writev
+    except (OSError, AttributeError):
+        return None
+
+_writev = _load_writev()
+
+def write_all(fd, buffers):
+    """ Write all of buffers to fd, together with writev where it is available
+    """
+    buffers = [b for b in buffers if b]
+    while buffers:
+        if _writev is None:
+            written = os.write(fd, buffers[0])
+        else:
+            iov = (_IOVec * len(buffers))(*[(b, len(b)) for b in buffers])
+            written = _writev(fd, iov, len(buffers))
+            if written < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                raise OSError(err, os.strerror(err))
+        while written:
+            if written >= len(buffers[0]):
+                written -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][written:]
+                written = 0
+
+class PipeWriter:
+    """ Writes payloads to a named pipe, prefixed by the header returned by header_func(length)
+
+    Payloads are written one at a time by a thread started with the first one.
+    write() blocks while more than max_buffered bytes are waiting to be written.
+    """
+    def __init__(self, pipe_file, header_func, max_buffered=16*1024*1024, retry_interval=5):
+        self.pipe_file = pipe_file
+        self.header_func = header_func
+        self.max_buffered = max_buffered
+        self.retry_interval = retry_interval
+        self.written = 0
+        self.bytes_written = 0
+        self.reconnects = 0
+        self.failed = 0
+        self.__queue = deque()
+        self.__buffered = 0
+        self.__cond = threading.Condition()
+        self.__fd = None
+        self.__thread = None
+
+    def write(self, data, length):
+        """ Queue length bytes read from the file data, which is closed once they have been written
+        """
+        with self.__cond:
+            while self.__buffered and self.__buffered + length > self.max_buffered:
+                self.__cond.wait()
+            self.__queue.append((data, length))
+            self.__buffered += length
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run)
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__cond.notify_all()
+
+    def stats(self):
+        with self.__cond:
+            return {
+                'queued': len(self.__queue),
+                'buffered': self.__buffered,
+                'written': self.written,
+                'bytes_written': self.bytes_written,
+                'reconnects': self.reconnects,
+                'failed': self.failed
+            }
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not self.__queue:
+                    self.__cond.wait()
+                (data, length) = self.__queue[0]
+            try:
+                self.__send(data, length)
+                self.written += 1
+                self.bytes_written += length
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+                self.failed += 1
+                self.__close()
+            finally:
+                data.close()
+                with self.__cond:
+                    self.__queue.popleft()
+                    self.__buffered -= length
+                    self.__cond.notify_all()
+
+    def __send(self, data, length):
+        while True:
+            fd = self.__connect()
+            data.seek(0)
+            try:
+                write_all(fd, [self.header_func(length), data.read(WRITE_CHUNK)])
+                for chunk in iter(lambda: data.read(WRITE_CHUNK), b''):
+                    write_all(fd, [chunk])
+                return
+            except OSError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                ## the reader went away, write the whole payload again to the next one
+                print("Reader of " + self.pipe_file + " closed the pipe, reopening it")
+                self.reconnects += 1
+                self.__close()
+
+    def __connect(self):
+        """ Open the pipe for writing, waiting for it to exist and have a reader
+        """
+        while self.__fd is None:
+            try:
+                fd = os.open(self.pipe_file, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno not in (errno.ENXIO, errno.ENOENT):
+                    raise
+                sleep(self.retry_interval)
+                continue
+            ## only opening should not block, writes wait for the reader
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            self.__fd = fd
+        return self.__fd
+
+    def __close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+class PipeSink:
+    """ Spools the data of one payload to a temporary file, handed to a PipeWriter once complete
+    """
+    def __init__(self, pipe_writer, spool_max_size=1024*1024):
+        self.pipe_writer = pipe_writer
+        self.__spool = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+        self.__length = 0
+
+    def write(self, data):
+        self.__spool.write(data)
+        self.__length += len(data)
+
+    def close(self):
+        self.pipe_writer.write(self.__spool, self.__length)
+
+    def abort(self):
+        self.__spool.close()
+
+class FileSink:
+    """ Writes data to a hidden temporary file beside path, renamed to path once complete
+    """
+    def __init__(self, path):
+        self.path = path
+        (directory, name) = os.path.split(path)
+        self.tmp_path = os.path.join(directory, '.' + name + '.part')
+        self.__file = open(self.tmp_path, 'wb')
+
+    def write(self, data):
+        self.__file.write(data)
+
+    def close(self):
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__file.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        self.__file.close()
+        os.remove(self.tmp_path)
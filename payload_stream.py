@@ -0,0 +1,139 @@
+'''
+Progressive decoding of message data as its segments arrive
+
+The segments of a payload received in sequence are base64 decoded, decompressed
+and written out as they arrive, rather than once the whole payload has been
+reassembled, so little is left to do once the last segment arrives and no copy
+of the whole file, encoded or decoded, is held in memory. See output_sink.py for
+the sinks the data is written to.
+'''
+
+import binascii
+import threading
+import traceback
+import compression
+
+class PayloadStream:
+    """ Decodes the base64 text of a payload compressed with codec, written to sink a part at a time
+
+    sink may be None to only count the decoded bytes.
+    """
+    def __init__(self, codec, sink):
+        self.sink = sink
+        self.next_seq = 0
+        self.size = 0
+        self.lock = threading.Lock()
+        self.__decompressor = compression.Decompressor(codec)
+        ## base64 characters short of a whole unit
+        self.__text = ''
+
+    def feed(self, segments):
+        """ Decode segments, which continue in sequence from those already fed
+        """
+        text = self.__text + ''.join(segment.payload for segment in segments if segment.payload is not None)
+        if segments:
+            self.next_seq = segments[-1].sequence_num + 1
+        whole = len(text) - len(text) % 4
+        self.__text = text[whole:]
+        if whole:
+            self.__write(self.__decompressor.decompress(binascii.a2b_base64(text[:whole])))
+
+    def close(self):
+        """ Write the rest of the data and close the sink
+        """
+        if self.__text:
+            raise ValueError("Payload ends with an incomplete base64 unit")
+        self.__write(self.__decompressor.flush())
+        if self.sink is not None:
+            self.sink.close()
+
+    def abort(self):
+        if self.sink is not None:
+            self.sink.abort()
+
+    def __write(self, data):
+        if data:
+            self.size += len(data)
+            if self.sink is not None:
+                self.sink.write(data)
+
+class PayloadStreams:
+    """ Decodes message data payloads from a SegmentStorage as their segments arrive
+
+    open_sink(filename) is called with the file name from the head segment of a
+    payload for the sink to write it to, or None to discard it.
+    """
+    def __init__(self, storage, open_sink):
+        self.storage = storage
+        self.open_sink = open_sink
+        ## payload id to stream, or to None once finishing or failed
+        self.__streams = {}
+        self.__lock = threading.Lock()
+
+    def update(self, payload_id):
+        """ Decode the segments of payload_id received in sequence since the last update
+        """
+        with self.__lock:
+            abandoned = self.__abandon()
+        for stream in abandoned:
+            with stream.lock:
+                stream.abort()
+
+        with self.__lock:
+            if payload_id in self.__streams and self.__streams[payload_id] is None:
+                return
+            stream = self.__streams.get(payload_id)
+            if stream is None:
+                stream = self.__open(payload_id)
+                if stream is None:
+                    return
+                self.__streams[payload_id] = stream
+
+        with stream.lock:
+            try:
+                stream.feed(self.storage.get_in_order(payload_id, stream.next_seq))
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+                stream.abort()
+                with self.__lock:
+                    if self.__streams.get(payload_id) is stream:
+                        self.__streams[payload_id] = None
+
+    def finish(self, payload_id):
+        """ Decode the rest of the complete payload_id and close its sink, returning the bytes decoded
+        """
+        with self.__lock:
+            stream = self.__streams.get(payload_id)
+            self.__streams[payload_id] = None
+        try:
+            if stream is None:
+                stream = self.__open(payload_id)
+            with stream.lock:
+                try:
+                    stream.feed(self.storage.get_in_order(payload_id, stream.next_seq))
+                    stream.close()
+                except Exception:
+                    stream.abort()
+                    raise
+            return stream.size
+        finally:
+            self.storage.remove(payload_id)
+            with self.__lock:
+                self.__streams.pop(payload_id, None)
+
+    def __open(self, payload_id):
+        segments = self.storage.get_in_order(payload_id, 0)
+        if not segments:
+            return None
+        head = segments[0]
+        return PayloadStream(head.codec, self.open_sink(head.tx_hash))
+
+    def __abandon(self):
+        """ Streams of payloads evicted before they were complete, to abort
+        """
+        abandoned = []
+        for (payload_id, stream) in self.__streams.items():
+            if stream is not None and not self.storage.has(payload_id):
+                del self.__streams[payload_id]
+                abandoned.append(stream)
+        return abandoned
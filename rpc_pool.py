@@ -0,0 +1,230 @@
+'''
+Shared connections to the local bitcoind JSON-RPC interface
+
+A small pool of bitcoin.rpc.Proxy connections is kept open and shared between
+threads, so bitcoin.conf is read and a connection made only when the pool grows.
+Calls can be sent together as one JSON-RPC batch request, and calls submitted by
+different threads within a short window are coalesced into one batch.
+
+bitcoind closes connections idle for longer than its rpcservertimeout, so proxies
+idle for longer than max_idle seconds are closed instead of reused, and a call that
+fails with a connection error on a reused proxy is sent again on another.
+'''
+
+from binascii import hexlify
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread, Condition, Event, Lock
+from time import sleep, time
+
+import bitcoin.rpc
+from bitcoin.rpc import JSONRPCError
+import metrics
+
+## bitcoind error code for an unknown transaction
+RPC_INVALID_ADDRESS_OR_KEY = -5
+
+RPC_SECONDS = metrics.histogram('txtenna_rpc_seconds', 'Latency of bitcoind JSON-RPC requests, single or batched')
+
+class RPCPool:
+
+    def __init__(self, proxy_factory=bitcoin.rpc.Proxy, size=4, batch_window=0.05, max_batch=100, max_idle=20):
+        self.proxy_factory = proxy_factory
+        self.size = size
+        self.max_idle = max_idle
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.requests = 0
+        self.calls = 0
+        self.__idle = []
+        self.__created = 0
+        self.__condition = Condition()
+        self.__submitted = deque()
+        self.__submit_condition = Condition()
+        self.__start_lock = Lock()
+        self.__thread = None
+
+    @contextmanager
+    def proxy(self):
+        """ Borrow a Proxy from the pool for the duration of a with block
+
+        A proxy that fails with anything but a JSON-RPC error is closed instead
+        of being returned, since its connection may be unusable.
+        """
+        (proxy, _) = self.__checkout()
+        with self.__lent(proxy):
+            yield proxy
+
+    def call(self, method, *args):
+        """ Call method with JSON encodable args and return its JSON result
+        """
+        def send(proxy):
+            with self.__condition:
+                self.requests += 1
+                self.calls += 1
+            with RPC_SECONDS.time():
+                return proxy.call(method, *args)
+        return self.__request(send)
+
+    def batch(self, calls):
+        """ Send calls, a list of (method, args), as one request
+
+        Returns a (result, error) pair for each call, in the same order.
+        """
+        if not calls:
+            return []
+        rpc_calls = [{'version': '1.1', 'method': method, 'params': list(args), 'id': n}
+                     for (n, (method, args)) in enumerate(calls)]
+        def send(proxy):
+            with self.__condition:
+                self.requests += 1
+                self.calls += len(calls)
+            with RPC_SECONDS.time():
+                return proxy._batch(rpc_calls) # pylint: disable=protected-access
+        responses = self.__request(send)
+
+        results = [(None, {'code': -343, 'message': 'missing JSON-RPC result'})] * len(calls)
+        for response in responses:
+            results[response['id']] = (response.get('result'), response.get('error'))
+        return results
+
+    def submit(self, method, *args):
+        """ Call method in the next batch sent, returning its JSON result
+
+        Calls submitted by other threads within batch_window go out in the same request.
+        """
+        self.__start()
+        call = {'method': method, 'args': args, 'done': Event(), 'result': None, 'error': None}
+        with self.__submit_condition:
+            self.__submitted.append(call)
+            self.__submit_condition.notify()
+        call['done'].wait()
+        if isinstance(call['error'], Exception):
+            raise call['error']
+        elif call['error'] is not None:
+            raise JSONRPCError(call['error'])
+        return call['result']
+
+    def getrawtransactions(self, tx_hashes):
+        """ Look up tx_hashes in one request, returning a dict of the verbose JSON of each
+
+        Transactions unknown to bitcoind map to None.
+        """
+        results = self.batch([('getrawtransaction', (tx_hash, 1)) for tx_hash in tx_hashes])
+        found = {}
+        for (tx_hash, (result, error)) in zip(tx_hashes, results):
+            if error is not None and error.get('code') != RPC_INVALID_ADDRESS_OR_KEY:
+                raise JSONRPCError(error)
+            found[tx_hash] = result
+        return found
+
+    def sendrawtransaction(self, tx_bytes):
+        """ Submit a serialized transaction, batched with any others sent at the same time
+        """
+        return self.submit('sendrawtransaction', hexlify(tx_bytes))
+
+    def stats(self):
+        with self.__condition:
+            return {'connections': self.__created, 'idle': len(self.__idle),
+                    'requests': self.requests, 'calls': self.calls}
+
+    def __request(self, send):
+        """ Return send(proxy) with a pooled proxy
+
+        A connection error on a reused proxy, eg. closed by bitcoind while idle, is
+        retried on the next proxy, until one newly connected fails as well.
+        """
+        (proxy, reused) = self.__checkout()
+        try:
+            with self.__lent(proxy):
+                return send(proxy)
+        except JSONRPCError:
+            raise
+        except Exception: # pylint: disable=broad-except
+            if not reused:
+                raise
+        return self.__request(send)
+
+    @contextmanager
+    def __lent(self, proxy):
+        try:
+            yield
+        except JSONRPCError:
+            self.__checkin(proxy)
+            raise
+        except BaseException:
+            self.__discard(proxy)
+            raise
+        else:
+            self.__checkin(proxy)
+
+    def __checkout(self):
+        """ (proxy, True if it was used before) of an idle proxy, or a new one if there are none
+        """
+        with self.__condition:
+            ## close proxies idle for too long, the oldest first
+            expiry = time() - self.max_idle
+            while self.__idle and self.__idle[0][1] < expiry:
+                (proxy, _) = self.__idle.pop(0)
+                self.__close(proxy)
+                self.__created -= 1
+            while not self.__idle and self.__created >= self.size:
+                self.__condition.wait()
+            if self.__idle:
+                return (self.__idle.pop()[0], True)
+            self.__created += 1
+        try:
+            return (self.proxy_factory(), False)
+        except BaseException:
+            with self.__condition:
+                self.__created -= 1
+                self.__condition.notify()
+            raise
+
+    def __checkin(self, proxy):
+        with self.__condition:
+            self.__idle.append((proxy, time()))
+            self.__condition.notify()
+
+    def __discard(self, proxy):
+        self.__close(proxy)
+        with self.__condition:
+            self.__created -= 1
+            self.__condition.notify()
+
+    def __close(self, proxy):
+        try:
+            proxy.close()
+        except Exception: # pylint: disable=broad-except
+            pass
+
+    def __start(self):
+        with self.__start_lock:
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run)
+                self.__thread.daemon = True
+                self.__thread.start()
+
+    def __run(self):
+        while True:
+            with self.__submit_condition:
+                while not self.__submitted:
+                    self.__submit_condition.wait()
+            ## give other threads a moment to add their calls to this batch
+            sleep(self.batch_window)
+            with self.__submit_condition:
+                calls = []
+                while self.__submitted and len(calls) < self.max_batch:
+                    calls.append(self.__submitted.popleft())
+
+            try:
+                results = self.batch([(call['method'], call['args']) for call in calls])
+                for (call, (result, error)) in zip(calls, results):
+                    call['result'] = result
+                    call['error'] = error
+            except Exception as e: # pylint: disable=broad-except
+                ## raised again in each submitting thread
+                for call in calls:
+                    call['error'] = e
+            for call in calls:
+                call['done'].set()
@@ -0,0 +1,62 @@
+'''
+Bounded set of recently seen keys
+
+Used to recognise payloads and transactions that were already handled when
+their segments are heard again, eg. from a repeated broadcast or from another
+sender relaying the same transaction. Keys are forgotten after ttl seconds, or
+oldest first once there are more than capacity of them.
+'''
+
+import threading
+from collections import OrderedDict
+from time import time
+
+class SeenFilter:
+
+    def __init__(self, capacity=10000, ttl=6*3600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.__seen = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def add(self, key):
+        """ Remember key, returning False if it was already seen
+        """
+        with self.__lock:
+            self.__expire()
+            if key in self.__seen:
+                self.hits += 1
+                return False
+            self.__seen[key] = time()
+            while len(self.__seen) > self.capacity:
+                self.__seen.popitem(last=False)
+            return True
+
+    def seen(self, key):
+        """ Return True, and count a duplicate, if key was already seen
+        """
+        with self.__lock:
+            self.__expire()
+            if key in self.__seen:
+                self.hits += 1
+                return True
+            return False
+
+    def discard(self, key):
+        """ Forget key, eg. if handling it failed and it should be handled again
+        """
+        with self.__lock:
+            self.__seen.pop(key, None)
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__seen)
+
+    def __expire(self):
+        expiry = time() - self.ttl
+        while self.__seen:
+            (key, added) = next(self.__seen.iteritems())
+            if added > expiry:
+                break
+            del self.__seen[key]
@@ -0,0 +1,226 @@
+'''
+Forwards received transaction segments to txtenna-server
+
+Segments of the same payload heard within a short window are coalesced into one
+batch and posted back to back over a pooled keep-alive session. A batch that
+cannot be delivered is retried with exponential backoff, and after max_attempts
+it is spooled to disk, if a spool directory is given, to be sent again once the
+server can be reached.
+'''
+
+import binascii
+import heapq
+import os
+import traceback
+from threading import Thread, Condition, Lock
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+HTTP_SECONDS = metrics.histogram('txtenna_forward_http_seconds', 'Latency of posting a segment to txtenna-server')
+
+class SegmentForwarder:
+
+    def __init__(self, url='https://api.samouraiwallet.com/v2/txtenna/segments', window=0.5,
+                 max_attempts=5, initial_backoff=1.0, max_backoff=60.0, spool_dir=None,
+                 spool_interval=60, request_timeout=10, pool_size=4):
+        self.url = url
+        self.window = window
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.spool_dir = spool_dir
+        self.spool_interval = spool_interval
+        self.request_timeout = request_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.forwarded = 0
+        self.batches = 0
+        self.retries = 0
+        self.rejected = 0
+        self.spooled = 0
+        self.__open = {}
+        self.__schedule = []
+        self.__spool_queued = set()
+        self.__last_spool_check = 0
+        self.__seq = 0
+        self.__condition = Condition()
+        self.__start_lock = Lock()
+        self.__thread = None
+        if self.spool_dir is not None:
+            if not os.path.isdir(self.spool_dir):
+                os.makedirs(self.spool_dir)
+            ## send whatever was spooled before a restart
+            self.__start()
+
+    def forward(self, segment):
+        """ Queue segment to be posted with the other segments of its payload
+        """
+        self.__start()
+        with self.__condition:
+            batch = self.__open.get(segment.payload_id)
+            if batch is None:
+                batch = self.__batch(segment.payload_id, [])
+                self.__open[segment.payload_id] = batch
+                self.__schedule_batch(batch, time() + self.window)
+            batch['segments'].append(segment.serialize_to_json())
+
+    def flush(self, payload_id):
+        """ Post the segments queued for payload_id without waiting for the rest of the window
+        """
+        with self.__condition:
+            batch = self.__open.pop(payload_id, None)
+            if batch is not None:
+                self.__schedule_batch(batch, time())
+
+    def stats(self):
+        with self.__condition:
+            return {
+                'pending': sum(len(batch['segments']) for (_, seq, batch) in self.__schedule
+                               if seq == batch['seq']),
+                'forwarded': self.forwarded,
+                'batches': self.batches,
+                'retries': self.retries,
+                'rejected': self.rejected,
+                'spooled': self.spooled
+            }
+
+    def __batch(self, payload_id, segments, spool_path=None):
+        return {'payload_id': payload_id, 'segments': segments, 'attempts': 0,
+                'backoff': self.initial_backoff, 'spool_path': spool_path, 'seq': None}
+
+    def __schedule_batch(self, batch, when):
+        """ Schedule batch to be sent at when, replacing any earlier schedule for it
+        """
+        self.__seq += 1
+        batch['seq'] = self.__seq
+        heapq.heappush(self.__schedule, (when, self.__seq, batch))
+        self.__condition.notify()
+
+    def __start(self):
+        with self.__start_lock:
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run)
+                self.__thread.daemon = True
+                self.__thread.start()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__schedule or self.__schedule[0][0] > time():
+                    wait = self.spool_interval
+                    if self.__schedule:
+                        wait = min(wait, self.__schedule[0][0] - time())
+                    self.__condition.wait(wait)
+                    if self.__spool_due():
+                        break
+                batch = None
+                if self.__schedule and self.__schedule[0][0] <= time():
+                    (_, seq, batch) = heapq.heappop(self.__schedule)
+                    if seq != batch['seq']:
+                        ## rescheduled, eg. flushed before the end of its window
+                        batch = None
+                    elif self.__open.get(batch['payload_id']) is batch:
+                        del self.__open[batch['payload_id']]
+
+            try:
+                if batch is not None:
+                    self.__send(batch)
+                if self.__spool_due():
+                    self.__load_spool()
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+
+    def __send(self, batch):
+        """ Post the segments of batch in order, rescheduling whatever could not be sent
+        """
+        if batch['attempts'] == 0 and batch['spool_path'] is None:
+            with self.__condition:
+                self.batches += 1
+        while batch['segments']:
+            try:
+                with HTTP_SECONDS.time():
+                    r = self.session.post(self.url, headers={u'content-type': u'application/json'},
+                                          data=batch['segments'][0], timeout=self.request_timeout)
+            except requests.exceptions.RequestException as e:
+                print("Could not forward segment of " + batch['payload_id'] + ": " + str(e))
+                self.__retry(batch)
+                return
+
+            if r.status_code >= 500:
+                print("txtenna-server error " + str(r.status_code) + " forwarding segment of " + batch['payload_id'])
+                self.__retry(batch)
+                return
+
+            print(r.text)
+            with self.__condition:
+                if r.status_code >= 400:
+                    ## the server will never accept it, so do not retry
+                    self.rejected += 1
+                else:
+                    self.forwarded += 1
+            batch['segments'].pop(0)
+
+        if batch['spool_path'] is not None:
+            os.remove(batch['spool_path'])
+            with self.__condition:
+                self.__spool_queued.discard(batch['spool_path'])
+        elif self.spool_dir is not None:
+            ## the server is reachable again
+            with self.__condition:
+                self.__last_spool_check = 0
+
+    def __retry(self, batch):
+        batch['attempts'] += 1
+        if batch['attempts'] >= self.max_attempts:
+            self.__spool(batch)
+            return
+        with self.__condition:
+            self.retries += 1
+            self.__schedule_batch(batch, time() + batch['backoff'])
+            batch['backoff'] = min(self.max_backoff, batch['backoff'] * 2)
+
+    def __spool(self, batch):
+        if batch['spool_path'] is not None:
+            ## already on disk, try again at the next spool check
+            with self.__condition:
+                self.__spool_queued.discard(batch['spool_path'])
+            return
+        if self.spool_dir is None:
+            print("Dropped " + str(len(batch['segments'])) + " segments of " + batch['payload_id'] +
+                  " after " + str(batch['attempts']) + " attempts")
+            return
+
+        ## Z85 payload ids may contain '/', so name the file after their hex
+        path = os.path.join(self.spool_dir, "{}-{:.6f}.spool".format(binascii.hexlify(batch['payload_id']), time()))
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(batch['segments']) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        with self.__condition:
+            self.spooled += len(batch['segments'])
+        print("Spooled " + str(len(batch['segments'])) + " segments of " + batch['payload_id'] + " to " + path)
+
+    def __spool_due(self):
+        return self.spool_dir is not None and time() - self.__last_spool_check >= self.spool_interval
+
+    def __load_spool(self):
+        """ Schedule the spooled batches that are not already waiting to be sent
+        """
+        with self.__condition:
+            self.__last_spool_check = time()
+            for filename in sorted(os.listdir(self.spool_dir)):
+                path = os.path.join(self.spool_dir, filename)
+                if not filename.endswith('.spool') or path in self.__spool_queued:
+                    continue
+                with open(path, 'r') as f:
+                    segments = [line.rstrip('\n') for line in f if line.strip()]
+                payload_id = binascii.unhexlify(filename.rsplit('-', 1)[0])
+                batch = self.__batch(payload_id, segments, path)
+                self.__spool_queued.add(path)
+                self.__schedule_batch(batch, time())
@@ -0,0 +1,116 @@
+'''
+Append-only journal of the segments held by SegmentStorage
+
+Each received segment is appended as a line of JSON and each payload removed
+from storage as a tombstone line, so partially reassembled payloads survive a
+restart. Lines are flushed as they are written and fsync'd in batches by a
+background thread. The journal is compacted to the live segments at startup
+and whenever removed segments outnumber them.
+'''
+
+import os
+import threading
+import traceback
+from collections import OrderedDict
+from txtenna_segment import TxTennaSegment
+
+class SegmentJournal:
+
+    def __init__(self, path, sync_interval=1.0, compact_min=1000):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_min = compact_min
+        self.__records = {}
+        self.__dead = 0
+        self.__dirty = False
+        self.__lock = threading.Lock()
+        self.__file = open(self.path, 'a')
+        self.__closed = threading.Event()
+        self.__thread = threading.Thread(target=self.__sync_loop)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def load(self):
+        """ Read the segments of the payloads that have not been removed, in the order received
+
+        An incomplete last line left by a crash is ignored.
+        """
+        payloads = OrderedDict()
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    if line.startswith('-'):
+                        payloads.pop(line[1:-1], None)
+                    elif line.startswith('+'):
+                        segment = TxTennaSegment.deserialize_from_json(line[1:-1])
+                        payloads.setdefault(segment.payload_id, []).append(segment)
+                except Exception: # pylint: disable=broad-except
+                    traceback.print_exc()
+        return [segment for segments in payloads.values() for segment in segments]
+
+    def append(self, segment):
+        with self.__lock:
+            self.__file.write('+' + segment.serialize_to_json() + '\n')
+            self.__file.flush()
+            self.__records[segment.payload_id] = self.__records.get(segment.payload_id, 0) + 1
+            self.__dirty = True
+
+    def remove(self, payload_id):
+        with self.__lock:
+            if payload_id not in self.__records:
+                return
+            self.__file.write('-' + payload_id + '\n')
+            self.__file.flush()
+            self.__dead += self.__records.pop(payload_id)
+            self.__dirty = True
+
+    def needs_compaction(self):
+        with self.__lock:
+            return self.__dead >= self.compact_min and self.__dead > sum(self.__records.values())
+
+    def compact(self, segments):
+        """ Replace the journal with one holding only segments
+        """
+        with self.__lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for segment in segments:
+                    f.write('+' + segment.serialize_to_json() + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.__file.close()
+            os.rename(tmp_path, self.path)
+            ## make the rename itself durable
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            self.__file = open(self.path, 'a')
+            self.__records = {}
+            for segment in segments:
+                self.__records[segment.payload_id] = self.__records.get(segment.payload_id, 0) + 1
+            self.__dead = 0
+            self.__dirty = False
+
+    def sync(self):
+        with self.__lock:
+            if self.__dirty:
+                self.__file.flush()
+                os.fsync(self.__file.fileno())
+                self.__dirty = False
+
+    def close(self):
+        self.__closed.set()
+        self.sync()
+        with self.__lock:
+            self.__file.close()
+
+    def __sync_loop(self):
+        while not self.__closed.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
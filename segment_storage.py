@@ -4,70 +4,437 @@ This module derived from Rich D's PyMuleTools respository:
 https://github.com/kansas-city-bitcoin-developers/PyMuleTools
 '''
 
-from txtenna_segment import TxTennaSegment
+import binascii
+import threading
+import traceback
+from collections import OrderedDict
+from time import time
+from zmq.utils import z85
+import fec
+import metrics
+from txtenna_segment import TxTennaSegment, payload_to_bytes, bytes_to_payload, MAX_SEGMENT_COUNT
 
-class SegmentStorage:
+## memory used by the slot and received flag of each segment of a payload, counted in its size
+SLOT_BYTES = 9
+
+REASSEMBLY_SECONDS = metrics.histogram('txtenna_payload_reassembly_seconds',
+                                       'Time from the first segment of a payload to its completion')
+PAYLOAD_BYTES = metrics.histogram('txtenna_payload_bytes', 'Size of the payload text of each payload completed',
+                                  metrics.SIZE_BUCKETS)
+
+class PayloadSlots:
+    """ Segments received for one payload, indexed by sequence number
+
+    Segments heard before the head segment are kept by sequence number until the
+    head's segment_count sizes the slots. Parity segments, numbered after the data
+    segments, are kept apart and used to recover lost data segments once enough
+    of them have been received. The data segments lost and parity segments received
+    are counted for each FEC group, so that only the group of a new segment is checked.
+
+    size counts the payload text stored and the memory of the slots, so that
+    evicting by size also limits heads that only claim many segments.
+    """
     def __init__(self):
-        self.__payloads = {}
+        self.head = None
+        self.slots = None
+        self.received = None
+        self.missing = None
+        self.early = {}
+        self.parity = {}
+        self.fec_parity = None
+        self.lost = None
+        self.parity_received = None
+        self.recovered = 0
+        self.size = 0
+        self.slot_size = 0
+        self.created = time()
+        self.updated = self.created
+        self.claimed = False
+
+    def put(self, segment):
+        """ Store segment, returning False if it is a duplicate or out of range
+        """
+        seq = segment.sequence_num
+        if not _valid_count(seq, 0):
+            return False
+        if seq == 0 and segment.segment_count is not None and not _valid_count(segment.segment_count, 1):
+            return False
+        if self.slots is None:
+            if seq in self.early:
+                return False
+            self.early[seq] = segment
+            self.__added(segment)
+            if seq == 0 and segment.segment_count is not None:
+                self.__allocate(segment)
+            return True
+
+        if segment.is_parity():
+            group = self.__parity_group(segment)
+            if group is None:
+                return False
+            self.parity[seq] = segment
+            self.parity_received[group] += 1
+            self.__added(segment)
+            self.__recover(group)
+            return True
+
+        if seq >= len(self.slots) or self.received[seq]:
+            return False
+        self.__store(seq, segment)
+        self.__added(segment)
+        self.__recover(seq // fec.FEC_GROUP)
+        return True
+
+    def is_complete(self):
+        return self.missing == 0
+
+    def missing_sequence_numbers(self):
+        """ Sequence numbers of the data segments not yet received
+
+        Before the head segment only the gaps up to the highest sequence number heard
+        are known, so the head is reported missing and later segments are not.
+        """
+        if self.slots is None:
+            data = [seq for seq in self.early if not self.early[seq].is_parity()]
+            return [seq for seq in range(max(data + [0]) + 1) if seq not in self.early]
+        return [seq for seq in range(len(self.slots)) if not self.received[seq]]
+
+    def __added(self, segment):
+        if segment.payload is not None:
+            self.size += len(segment.payload)
+        self.updated = time()
+
+    def segments(self):
+        """ Received data segments in sequence order
+        """
+        if self.slots is None:
+            return [self.early[seq] for seq in sorted(self.early) if not self.early[seq].is_parity()]
+        return [segment for segment in self.slots if segment is not None]
+
+    def stored_segments(self):
+        """ Received data and parity segments
+        """
+        if self.slots is None:
+            return [self.early[seq] for seq in sorted(self.early)]
+        return self.segments() + [self.parity[seq] for seq in sorted(self.parity)]
+
+    def __allocate(self, head):
+        count = head.segment_count
+        self.head = head
+        self.slots = [None] * count
+        self.received = bytearray(count)
+        self.missing = count
+        self.lost = fec.group_sizes(count)
+        self.parity_received = [0] * len(self.lost)
+        self.slot_size = count * SLOT_BYTES
+        self.size += self.slot_size
+        for (seq, segment) in self.early.items():
+            group = self.__parity_group(segment) if segment.is_parity() else None
+            if group is not None:
+                self.parity[seq] = segment
+                self.parity_received[group] += 1
+            elif seq < count and not segment.is_parity():
+                self.__store(seq, segment)
+            elif segment.payload is not None:
+                self.size -= len(segment.payload)
+        self.early = None
+        for group in range(len(self.lost)):
+            self.__recover(group)
+
+    def __store(self, seq, segment):
+        self.slots[seq] = segment
+        self.received[seq] = 1
+        self.missing -= 1
+        self.lost[seq // fec.FEC_GROUP] -= 1
+
+    def __parity_group(self, segment):
+        """ FEC group of a parity segment, or None if it is a duplicate or out of range
+        """
+        seq = segment.sequence_num
+        count = len(self.slots)
+        if seq < count or seq in self.parity or not _valid_count(segment.fec_parity, 1):
+            return None
+        if self.fec_parity is None:
+            self.fec_parity = segment.fec_parity
+        group = (seq - count) // self.fec_parity
+        if segment.fec_parity != self.fec_parity or group >= len(self.lost):
+            return None
+        return group
+
+    def __recover(self, group):
+        """ Rebuild the lost data segments of group from its parity segments, once enough have been received
+        """
+        if not 0 < self.lost[group] <= self.parity_received[group]:
+            return
+        count = len(self.slots)
+        seqs = range(group * fec.FEC_GROUP, min((group + 1) * fec.FEC_GROUP, count))
+        first = count + group * self.fec_parity
+        rows = [seq - first for seq in range(first, first + self.fec_parity) if seq in self.parity]
+
+        encoding = self.head.encoding
+        try:
+            blocks = [payload_to_bytes(self.slots[seq].payload, encoding) if self.received[seq] else None
+                      for seq in seqs]
+            parities = dict((row, payload_to_bytes(self.parity[first + row].payload, encoding)) for row in rows)
+            recovered = fec.decode_group(blocks, parities)
+            ## every data block but the head and the last is as long as the parity blocks
+            block_len = len(parities[rows[0]])
+            last_len = (self.parity[first + rows[0]].fec_length - len(payload_to_bytes(self.head.payload, encoding))
+                        - (count - 2) * block_len)
+        except Exception: # pylint: disable=broad-except
+            ## corrupt or inconsistent parity, wait for the data segments instead
+            traceback.print_exc()
+            return
+
+        for col in recovered:
+            seq = seqs[col]
+            length = last_len if seq == count - 1 else block_len
+            segment = TxTennaSegment(self.head.payload_id, bytes_to_payload(blocks[col][:length], encoding),
+                                     sequence_num=seq, encoding=encoding)
+            self.__store(seq, segment)
+            self.recovered += 1
+
+def _valid_count(value, minimum):
+    return isinstance(value, (int, long)) and not isinstance(value, bool) and minimum <= value <= MAX_SEGMENT_COUNT
+
+class SegmentStorage:
+    """ Reassembles payloads from their segments
+
+    Payloads are kept in least recently updated order. Any payload not updated
+    for ttl seconds is evicted, and the least recently updated incomplete payloads
+    are evicted while there are more than max_payloads or their payloads hold more
+    than max_bytes. Completed payloads should be removed once handed off.
+
+    With a SegmentJournal, the segments found in the journal are restored and each
+    segment stored or payload removed is recorded in it.
+    """
+    def __init__(self, max_payloads=1000, max_bytes=16*1024*1024, ttl=3600, journal=None):
+        self.max_payloads = max_payloads
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evicted_expired = 0
+        self.evicted_lru = 0
+        self.removed = 0
+        self.recovered = 0
+        self.__bytes = 0
+        self.__lock = threading.RLock()
+        self.__payloads = OrderedDict()
         self.__transactionLookup = {}
+        self.journal = None
+        if journal is not None:
+            for segment in journal.load():
+                self.put(segment)
+            journal.compact(self.__live_segments())
+            self.journal = journal
 
     def get_raw_tx(self, segments):
-        raw_tx = ""
-        for segment in segments:
-            if segment.payload is not None:
-                raw_tx += segment.payload
-        return raw_tx
+        """ Join the payload of segments, returning transactions sent with Z85 encoding as hex
+
+        The hex of a Z85 transaction keeps the zero bytes used to pad it.
+        """
+        head = next((s for s in segments if s.sequence_num == 0), None)
+        if head is not None and head.is_z85():
+            return self.get_payload_bytes(segments).encode("hex")
+        return "".join(segment.payload for segment in segments if segment.payload is not None)
+
+    def get_payload_bytes(self, segments):
+        """ Decode the payload of segments to a single byte string
+
+        The segment text is joined once and decoded in one pass from hex, Z85, or
+        base64 for message data. Z85 transactions keep the zero bytes used to pad them.
+        """
+        raw = "".join(segment.payload for segment in segments if segment.payload is not None)
+        head = next((s for s in segments if s.sequence_num == 0), None)
+        if head is not None and head.is_z85():
+            return z85.decode(raw)
+        elif head is not None and head.message:
+            return binascii.a2b_base64(raw)
+        return binascii.unhexlify(raw)
 
     def get(self, payload_id):
-        return self.__payloads[payload_id] if payload_id in self.__payloads else None
+        with self.__lock:
+            return self.__payloads[payload_id].segments() if payload_id in self.__payloads else None
 
     def get_by_transaction_id(self, tx_id):
-        if tx_id in self.__transactionLookup:
-            return self.__payloads[self.__transactionLookup[tx_id]]
-        return None
+        with self.__lock:
+            if tx_id in self.__transactionLookup:
+                return self.get(self.__transactionLookup[tx_id])
+            return None
+
+    def has(self, payload_id):
+        """ True while payload_id is being reassembled, or is complete and not yet removed
+        """
+        with self.__lock:
+            return payload_id in self.__payloads
+
+    def get_head(self, payload_id):
+        """ Head segment of payload_id, or None if it has not been received
+        """
+        return self.__get_head(payload_id)
 
     def get_transaction_id(self, payload_id):
-        if payload_id in self.__payloads:
-            for segment in self.__payloads[payload_id]:
-                    if segment.tx_hash is not None:
-                        return segment.tx_hash
+        head = self.__get_head(payload_id)
+        if head is not None:
+            return head.get_hex_tx_hash()
         return None
 
     def get_network(self, payload_id):
-        if payload_id in self.__payloads:
-            for segment in self.__payloads[payload_id]:
-                    if segment.tx_hash is not None:
-                        if segment.testnet is True:
-                            return 't'
-                        elif segment.message is True:
-                            return 'd'
-                        else:
-                            return 'm'
+        head = self.__get_head(payload_id)
+        if head is not None:
+            if head.testnet is True:
+                return 't'
+            elif head.message is True:
+                return 'd'
+            else:
+                return 'm'
 
     def remove(self, payload_id):
-        if payload_id in self.__payloads:
-            for segment in self.__payloads[payload_id]:
-                if segment.tx_hash is not None:
-                    del self.__transactionLookup[segment.tx_hash]
-                    break
-            del self.__payloads[payload_id]
+        with self.__lock:
+            if payload_id in self.__payloads:
+                self.__discard(payload_id)
+                self.removed += 1
+                self.__compact_journal()
+
+    def remove_by_transaction_id(self, tx_id):
+        with self.__lock:
+            if tx_id in self.__transactionLookup:
+                self.remove(self.__transactionLookup[tx_id])
 
     def put(self, segment):
-        if segment.payload_id in self.__payloads:
-            payload = self.__payloads[segment.payload_id]
-            payload.append(segment)
-            if segment.sequence_num+1 != len(payload):
-                self.__payloads[segment.payload_id].sort(key=lambda p: p.sequence_num)
-        else:
-            self.__payloads[segment.payload_id] = [segment]
+        """ Store a segment, returning False if it was already received
+
+        Block confirmations are not part of a payload and are not stored.
+        """
+        if segment.block is not None:
+            return False
+
+        with self.__lock:
+            payload = self.__payloads.pop(segment.payload_id, None)
+            new = payload is None
+            if new:
+                payload = PayloadSlots()
+            size = payload.size
+            recovered = payload.recovered
+            stored = payload.put(segment)
+            ## reinsert to keep the payloads in least recently updated order, unless nothing was stored for a new one
+            if stored or not new:
+                self.__payloads[segment.payload_id] = payload
+            if not stored:
+                return False
+            self.__bytes += payload.size - size
+            self.recovered += payload.recovered - recovered
+
+            if segment.tx_hash is not None:
+                self.__transactionLookup[segment.get_hex_tx_hash()] = segment.payload_id
+            if self.journal is not None:
+                self.journal.append(segment)
+            self.__evict(segment.payload_id)
+            return True
 
-        if segment.tx_hash is not None:
-            self.__transactionLookup[segment.tx_hash] = segment.payload_id
+    def claim_complete(self, payload_id):
+        """ Return True once, to the first caller that finds the payload complete
+        """
+        with self.__lock:
+            payload = self.__payloads.get(payload_id)
+            if payload is None or payload.claimed or not payload.is_complete():
+                return False
+            payload.claimed = True
+            REASSEMBLY_SECONDS.observe(time() - payload.created)
+            PAYLOAD_BYTES.observe(payload.size - payload.slot_size)
+            return True
+
+    def get_missing(self, payload_id):
+        """ Sequence numbers still missing for payload_id, or None if it is not being reassembled
+        """
+        with self.__lock:
+            if payload_id not in self.__payloads:
+                return None
+            return self.__payloads[payload_id].missing_sequence_numbers()
+
+    def get_in_order(self, payload_id, start):
+        """ Data segments of payload_id received in sequence from start, until the first one missing
+
+        Nothing is returned until the head segment has been received.
+        """
+        with self.__lock:
+            payload = self.__payloads.get(payload_id)
+            if payload is None or payload.slots is None:
+                return []
+            ret = []
+            for seq in range(start, len(payload.slots)):
+                if not payload.received[seq]:
+                    break
+                ret.append(payload.slots[seq])
+            return ret
+
+    def get_complete_payload_ids(self):
+        with self.__lock:
+            return [payload_id for (payload_id, payload) in self.__payloads.items() if payload.is_complete()]
 
     def is_complete(self, payload_id):
-        segments = self.get(payload_id)
-        if segments is not None:
-            segment = next((s for s in segments if s.segment_count is not None), None)
-            return segment is not None and segment.segment_count == len(segments)
+        with self.__lock:
+            if payload_id in self.__payloads:
+                return self.__payloads[payload_id].is_complete()
 
         return False
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'payloads': len(self.__payloads),
+                'bytes': self.__bytes,
+                'evicted_expired': self.evicted_expired,
+                'evicted_lru': self.evicted_lru,
+                'removed': self.removed,
+                'recovered': self.recovered
+            }
+
+    def __evict(self, current_id):
+        ## expired payloads, oldest first
+        expiry = time() - self.ttl
+        while self.__payloads:
+            (payload_id, payload) = next(self.__payloads.iteritems())
+            if payload.updated > expiry or payload_id == current_id:
+                break
+            self.__discard(payload_id)
+            self.evicted_expired += 1
+
+        ## least recently updated incomplete payloads, except the one just updated
+        excess_payloads = len(self.__payloads) - self.max_payloads
+        excess_bytes = self.__bytes - self.max_bytes
+        evict = []
+        for (payload_id, payload) in self.__payloads.iteritems():
+            if excess_payloads <= 0 and excess_bytes <= 0:
+                break
+            if payload_id == current_id or payload.is_complete():
+                continue
+            evict.append(payload_id)
+            excess_payloads -= 1
+            excess_bytes -= payload.size
+        for payload_id in evict:
+            self.__discard(payload_id)
+            self.evicted_lru += 1
+        self.__compact_journal()
+
+    def __discard(self, payload_id):
+        payload = self.__payloads.pop(payload_id)
+        self.__bytes -= payload.size
+        if self.journal is not None:
+            self.journal.remove(payload_id)
+        if payload.head is not None:
+            tx_id = payload.head.get_hex_tx_hash()
+            if self.__transactionLookup.get(tx_id) == payload_id:
+                del self.__transactionLookup[tx_id]
+
+    def __live_segments(self):
+        return [segment for payload in self.__payloads.values() for segment in payload.stored_segments()]
+
+    def __compact_journal(self):
+        if self.journal is not None and self.journal.needs_compaction():
+            self.journal.compact(self.__live_segments())
+
+    def __get_head(self, payload_id):
+        with self.__lock:
+            if payload_id in self.__payloads:
+                return self.__payloads[payload_id].head
+            return None
@@ -0,0 +1,105 @@
+'''
+Pacing of segments sent through the goTenna radio
+
+The next message is handed to the radio as soon as the driver callback for the
+previous one arrives. Send failures and rejected sends (a None correlation id)
+back off the delay between messages, successful sends shrink it again.
+'''
+
+import threading
+from collections import deque
+from time import time, sleep
+
+class SendPacer(object):
+
+    def __init__(self, min_delay=0.0, initial_backoff=1.0, max_delay=60.0, callback_timeout=30.0, window=20):
+        self.min_delay = min_delay
+        self.initial_backoff = initial_backoff
+        self.max_delay = max_delay
+        self.callback_timeout = callback_timeout
+        self.delay = min_delay
+        self.sent = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.__completions = deque(maxlen=window)
+        self.__send_lock = threading.Lock()
+        self.__ready = threading.Event()
+        self.__ready.set()
+
+    def wrap(self, callback):
+        """ Wrap a callback built by goTennaCLI.build_callback so its result paces the next send
+        """
+        def paced_callback(correlation_id, success=None, results=None,
+                           error=None, details=None):
+            try:
+                callback(correlation_id, success=success, results=results,
+                         error=error, details=details)
+            finally:
+                self.__done(bool(success))
+        return paced_callback
+
+    def send(self, send_func):
+        """ Call send_func() once the radio is ready and return its correlation id
+
+        send_func is retried with an increasing delay while it returns None. An
+        exception from send_func is raised again, after backing off the delay.
+        """
+        with self.__send_lock:
+            if not self.__ready.wait(self.callback_timeout):
+                self.timeouts += 1
+                self.__backoff()
+            while True:
+                if self.delay > 0:
+                    sleep(self.delay)
+                self.__ready.clear()
+                try:
+                    corr_id = send_func()
+                except Exception:
+                    ## nothing was handed to the radio, so no callback will make it ready
+                    self.__ready.set()
+                    self.rejected += 1
+                    self.__backoff()
+                    raise
+                if corr_id is not None:
+                    self.sent += 1
+                    return corr_id
+                ## radio did not accept the message, try again later
+                self.__ready.set()
+                self.rejected += 1
+                self.__backoff()
+
+    def rate(self):
+        """ Segments per second achieved over the most recent completed sends
+        """
+        completions = list(self.__completions)
+        if len(completions) < 2 or completions[-1] <= completions[0]:
+            return 0.0
+        return (len(completions) - 1) / (completions[-1] - completions[0])
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'delay': self.delay,
+            'segments_per_sec': self.rate()
+        }
+
+    def __done(self, success):
+        if success:
+            self.succeeded += 1
+            self.__completions.append(time())
+            self.delay = self.delay / 2
+            if self.delay < max(self.min_delay, self.initial_backoff / 8):
+                self.delay = self.min_delay
+        else:
+            self.failed += 1
+            self.__backoff()
+        self.__ready.set()
+
+    def __backoff(self):
+        self.delay = min(self.max_delay, max(self.initial_backoff, self.delay * 2))
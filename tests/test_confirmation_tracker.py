@@ -0,0 +1,142 @@
+""" ConfirmationTracker against a local ZMQ publisher standing in for bitcoind
+"""
+import threading
+import unittest
+from contextlib import contextmanager
+from time import time, sleep
+
+import zmq
+from bitcoin.core import lx, b2lx, COutPoint, CMutableTxIn, CMutableTxOut, CMutableTransaction, CTransaction
+from bitcoin.core.script import CScript
+
+from confirmation_tracker import ConfirmationTracker
+
+def make_tx(n):
+    txin = CMutableTxIn(COutPoint(lx('94406beb94761fa728a2cde836ca636ecd3c51cbc0febc87a968cb8522ce7cc1'), n),
+                        CScript(b'\x51'))
+    txout = CMutableTxOut(10000, CScript(b'\x00\x14' + b'\x11' * 20))
+    return CTransaction.from_tx(CMutableTransaction([txin], [txout]))
+
+def wait_for(predicate, timeout=10, action=None):
+    """ Wait for predicate() to be true, calling action() meanwhile, eg. to publish again for a late subscriber
+    """
+    deadline = time() + timeout
+    while not predicate():
+        if time() > deadline:
+            return False
+        if action is not None:
+            action()
+        sleep(0.05)
+    return True
+
+class FakeBlock:
+    def __init__(self, vtx):
+        self.vtx = vtx
+
+class FakeRPCPool:
+    """ The part of RPCPool used by ConfirmationTracker, answering from mempool and blocks
+    """
+    def __init__(self):
+        self.mempool = {}
+        self.blocks = {}
+        self.lookups = []
+
+    def getrawtransactions(self, tx_hashes):
+        self.lookups.append(list(tx_hashes))
+        return dict((tx_hash, self.mempool.get(tx_hash)) for tx_hash in tx_hashes)
+
+    @contextmanager
+    def proxy(self):
+        yield self
+
+    def getblock(self, block_hash):
+        return self.blocks[block_hash]
+
+class ConfirmationTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = zmq.Context.instance().socket(zmq.PUB)
+        port = self.publisher.bind_to_random_port('tcp://127.0.0.1')
+        self.zmq_url = 'tcp://127.0.0.1:{}'.format(port)
+        self.rpc = FakeRPCPool()
+        self.replies = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.publisher.close(linger=0)
+
+    def reply(self, sender_gid, tx_hash, confirmations):
+        with self.lock:
+            self.replies.append((sender_gid, tx_hash, confirmations))
+
+    def replied(self, *reply):
+        with self.lock:
+            return reply in self.replies
+
+    def publish(self, topic, body):
+        return lambda: self.publisher.send_multipart([topic, body, b'\0\0\0\0'])
+
+    def tracker(self, **kwargs):
+        return ConfirmationTracker(self.reply, self.rpc, zmq_url=self.zmq_url, **kwargs)
+
+    def test_mempool_reply_from_rawtx(self):
+        tx = make_tx(0)
+        tx_hash = b2lx(tx.GetTxid())
+        tracker = self.tracker()
+        tracker.track(tx_hash, 1111)
+        self.assertTrue(wait_for(lambda: self.rpc.lookups))
+        self.assertFalse(self.replies)
+
+        self.assertTrue(wait_for(lambda: self.replied(1111, tx_hash, 0), action=self.publish(b'rawtx', tx.serialize())))
+        self.assertEqual(tracker.pending(), 1)
+        self.assertEqual(self.replies, [(1111, tx_hash, 0)])
+
+    def test_mempool_reply_when_tracked(self):
+        tx_hash = b2lx(make_tx(1).GetTxid())
+        self.rpc.mempool[tx_hash] = {'confirmations': 0}
+        tracker = self.tracker()
+        tracker.track(tx_hash, 1111)
+        self.assertTrue(wait_for(lambda: self.replied(1111, tx_hash, 0)))
+        self.assertEqual(tracker.pending(), 1)
+
+    def test_hashblock_confirms_and_fans_out(self):
+        tx = make_tx(2)
+        tx_hash = b2lx(tx.GetTxid())
+        other = make_tx(3)
+        block_hash = lx('00000000000000000001f2b3c4d5e6f708192a3b4c5d6e7f8091a2b3c4d5e6f7')
+        self.rpc.blocks[block_hash] = FakeBlock([other, tx])
+
+        tracker = self.tracker()
+        for sender_gid in (1111, 2222, 3333, 2222):
+            tracker.track(tx_hash, sender_gid)
+        self.assertTrue(wait_for(lambda: self.rpc.lookups))
+
+        ## notifications carry the block hash in RPC byte order
+        self.assertTrue(wait_for(lambda: tracker.pending() == 0, action=self.publish(b'hashblock', block_hash[::-1])))
+        for sender_gid in (1111, 2222, 3333):
+            self.assertTrue(self.replied(sender_gid, tx_hash, 0))
+            self.assertTrue(self.replied(sender_gid, tx_hash, 1))
+        ## one mempool and one block reply to each sender, however often it asked
+        self.assertEqual(len(self.replies), 6)
+
+    def test_confirmed_when_tracked(self):
+        tx_hash = b2lx(make_tx(4).GetTxid())
+        self.rpc.mempool[tx_hash] = {'confirmations': 3}
+        tracker = self.tracker()
+        tracker.track(tx_hash, 1111)
+        self.assertTrue(wait_for(lambda: self.replied(1111, tx_hash, 3)))
+        self.assertEqual(self.replies, [(1111, tx_hash, 0), (1111, tx_hash, 3)])
+        self.assertEqual(tracker.pending(), 0)
+
+    def test_timeout(self):
+        tx_hash = b2lx(make_tx(5).GetTxid())
+        tracker = self.tracker(timeout=0.5, poll_interval=0.2)
+        tracker.track(tx_hash, 1111)
+        self.assertTrue(wait_for(lambda: tracker.pending() == 1))
+        self.assertTrue(wait_for(lambda: tracker.pending() == 0))
+        ## polled while no notifications arrived, then given up on
+        self.assertGreater(len(self.rpc.lookups), 1)
+        self.assertEqual(self.replies, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+""" Limits of SentSegmentCache on the segments kept to resend
+"""
+import unittest
+
+from nack import SentSegmentCache
+
+class SentSegmentCacheTest(unittest.TestCase):
+
+    def test_resends_once_within_holdoff(self):
+        cache = SentSegmentCache()
+        cache.start('a', 3)
+        for seq in range(5):
+            cache.add('a', seq, 'frame{}'.format(seq))
+        self.assertEqual(cache.get('a', [1, 3, 9]), (3, ['frame1', 'frame3']))
+        self.assertEqual(cache.get('a', [1, 4]), (3, ['frame4']))
+        self.assertIsNone(cache.get('b', [1]))
+
+    def test_forgets_oldest_payloads_over_max_bytes(self):
+        cache = SentSegmentCache(max_bytes=1000)
+        for payload_id in ('a', 'b', 'c'):
+            cache.start(payload_id, 3)
+            for seq in range(4):
+                cache.add(payload_id, seq, 'x' * 100)
+        self.assertIsNone(cache.get('a', [0]))
+        self.assertEqual(len(cache.get('b', range(4))[1]), 4)
+        self.assertEqual(cache.stats()['bytes'], 800)
+
+    def test_keeps_latest_segments_of_a_large_payload(self):
+        cache = SentSegmentCache(max_bytes=1000)
+        cache.start('a', 3)
+        for seq in range(50):
+            cache.add('a', seq, 'x' * 100)
+        self.assertEqual(cache.get('a', range(40))[1], [])
+        self.assertEqual(len(cache.get('a', range(40, 50))[1]), 10)
+        self.assertEqual(cache.stats()['bytes'], 1000)
+
+    def test_new_broadcast_replaces_segments_of_same_id(self):
+        cache = SentSegmentCache()
+        cache.start('a', 3)
+        cache.add('a', 0, 'old0')
+        cache.add('a', 1, 'old1')
+        cache.start('a', 1)
+        cache.add('a', 0, 'new0')
+        self.assertEqual(cache.get('a', [0, 1]), (1, ['new0']))
+        self.assertEqual(cache.stats()['bytes'], 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+""" OnlineConfirmationPoller against a local HTTP stub of the /v2/tx/<hash> endpoint
+"""
+import json
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from time import time, sleep
+
+from online_poller import OnlineConfirmationPoller
+
+TX_HASH = '94406beb94761fa728a2cde836ca636ecd3c51cbc0febc87a968cb8522ce7cc1'
+
+def wait_for(predicate, timeout=10):
+    deadline = time() + timeout
+    while not predicate():
+        if time() > deadline:
+            return False
+        sleep(0.02)
+    return True
+
+class StubServer:
+    """ Answers GET /v2/tx/<hash> and /test/v2/tx/<hash> from responses, 404 for unknown hashes
+    """
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append((time(), self.path))
+                tx_hash = self.path.rsplit('/', 1)[-1]
+                if tx_hash not in stub.responses:
+                    self.send_error(404)
+                    return
+                body = json.dumps(stub.responses[tx_hash])
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args): # pylint: disable=redefined-builtin
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request_times(self, path):
+        return [t for (t, p) in self.requests if p == path]
+
+class OnlineConfirmationPollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubServer()
+        self.replies = []
+        self.pollers = []
+
+    def tearDown(self):
+        for poller in self.pollers:
+            poller.stop()
+        self.stub.close()
+
+    def reply(self, sender_gid, tx_hash, block):
+        self.replies.append((sender_gid, tx_hash, block))
+
+    def poller(self, **kwargs):
+        poller = OnlineConfirmationPoller(self.reply, server=self.stub.url, **kwargs)
+        self.pollers.append(poller)
+        return poller
+
+    def test_not_found_backs_off(self):
+        poller = self.poller(interval=0.05, max_interval=0.4)
+        poller.track(TX_HASH, 1111, 'm')
+        self.assertTrue(wait_for(lambda: len(self.stub.request_times('/v2/tx/' + TX_HASH)) >= 6))
+        times = self.stub.request_times('/v2/tx/' + TX_HASH)
+        gaps = [b - a for (a, b) in zip(times, times[1:])]
+        ## each check of a missing transaction waits twice as long, up to max_interval
+        self.assertGreater(gaps[1], gaps[0] * 1.5)
+        self.assertGreater(gaps[2], gaps[1] * 1.5)
+        self.assertLess(gaps[-1], 0.4 * 1.5)
+        self.assertEqual(self.replies, [])
+        self.assertEqual(poller.pending(), 1)
+
+    def test_mempool_reply(self):
+        self.stub.responses[TX_HASH] = {'txid': TX_HASH}
+        poller = self.poller(interval=0.05)
+        poller.track(TX_HASH, 1111, 't')
+        poller.track(TX_HASH, 2222, 't')
+        self.assertTrue(wait_for(lambda: len(self.stub.request_times('/test/v2/tx/' + TX_HASH)) >= 3))
+        ## reported once to each sender, while still waiting for a block
+        self.assertEqual(self.replies, [(1111, TX_HASH, 0), (2222, TX_HASH, 0)])
+        self.assertEqual(poller.pending(), 1)
+
+    def test_confirmed_reply(self):
+        poller = self.poller(interval=0.05)
+        poller.track(TX_HASH, 1111, 'm')
+        self.assertTrue(wait_for(lambda: self.stub.requests))
+        self.stub.responses[TX_HASH] = {'txid': TX_HASH}
+        self.assertTrue(wait_for(lambda: self.replies))
+        self.stub.responses[TX_HASH] = {'txid': TX_HASH, 'block': {'height': 600000}}
+        self.assertTrue(wait_for(lambda: poller.pending() == 0))
+        self.assertEqual(self.replies, [(1111, TX_HASH, 0), (1111, TX_HASH, 600000)])
+
+        ## no more checks once confirmed
+        checks = len(self.stub.requests)
+        sleep(0.3)
+        self.assertEqual(len(self.stub.requests), checks)
+
+    def test_gives_up_after_timeout(self):
+        poller = self.poller(interval=0.05, max_interval=0.1, timeout=0.5)
+        poller.track(TX_HASH, 1111, 'm')
+        self.assertTrue(wait_for(lambda: self.stub.requests))
+        self.assertTrue(wait_for(lambda: poller.pending() == 0))
+        checks = len(self.stub.requests)
+        sleep(0.3)
+        self.assertEqual(len(self.stub.requests), checks)
+        self.assertEqual(self.replies, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+""" Round trip of transactions through segments, the JSON and binary formats and SegmentStorage
+
+Run from the top of the repository with: python -m unittest discover -s tests
+"""
+import unittest
+from io import BytesIO
+
+from bitcoin.core import lx, b2x, b2lx, COutPoint, CMutableTxIn, CMutableTxOut, CMutableTransaction
+from bitcoin.core.script import CScript
+
+from txtenna_segment import TxTennaSegment
+from segment_storage import SegmentStorage
+
+GID = 2573394689
+
+## a segwit transaction, as in the mesh_broadcast_rawtx help
+SEGWIT_TX = '01000000000101bf6c3ed233e8700b42c1369993c2078780015bab7067b9751b7f49f799efbffd0000000017160014f25dbf0eab0ba7e3482287ebb41a7f6d361de6efffffffff02204e00000000000017a91439cdb4242013e108337df383b1bf063561eb582687abb93b000000000017a9148b963056eedd4a02c91747ea667fc34548cab0848702483045022100e92ce9b5c91dbf1c976d10b2c5ed70d140318f3bf2123091d9071ada27a4a543022030c289d43298ca4ca9d52a4c85f95786c5e27de5881366d9154f6fe13a717f3701210204b40eff96588033722f487a52d39a345dc91413281b31909a4018efb330ba2600000000'
+
+def make_tx(script_len, outputs=1):
+    """ Hex of a transaction whose length varies with script_len, and its hash
+    """
+    txin = CMutableTxIn(COutPoint(lx('94406beb94761fa728a2cde836ca636ecd3c51cbc0febc87a968cb8522ce7cc1'), 1),
+                        CScript(b'\x51' * script_len))
+    txouts = [CMutableTxOut(10000 + n, CScript(b'\x00\x14' + b'\x11' * 20)) for n in range(outputs)]
+    tx = CMutableTransaction([txin], txouts)
+    return (b2x(tx.serialize()), b2lx(tx.GetTxid()))
+
+def test_transactions():
+    """ Transactions of every length modulo 4, of one and of many segments
+    """
+    txs = [make_tx(script_len) for script_len in range(10, 14)]
+    txs += [make_tx(script_len, outputs=40) for script_len in range(10, 14)]
+    tx = CMutableTransaction.stream_deserialize(BytesIO(SEGWIT_TX.decode('hex')))
+    txs.append((SEGWIT_TX, b2lx(tx.GetTxid())))
+    return txs
+
+class SegmentRoundTripTest(unittest.TestCase):
+
+    def roundtrip(self, strHexTx, strHexTxHash, isZ85, isBinary, order=None):
+        segments = TxTennaSegment.tx_to_segments(GID, strHexTx, strHexTxHash, '7', 'm', isZ85, isBinary)
+        if isBinary:
+            frames = [segment.serialize_to_binary() for segment in segments]
+            self.assertTrue(all(len(frame) <= 210 for frame in frames))
+        else:
+            frames = [segment.serialize_to_json() for segment in segments]
+        if order is not None:
+            frames = order(frames)
+
+        storage = SegmentStorage()
+        for frame in frames:
+            self.assertTrue(storage.put(TxTennaSegment.deserialize_from_json(frame)))
+        payload_id = segments[0].payload_id
+        self.assertTrue(storage.is_complete(payload_id))
+        self.assertEqual(storage.get_transaction_id(payload_id), strHexTxHash)
+
+        received = storage.get_by_transaction_id(strHexTxHash)
+        raw_tx_bytes = storage.get_payload_bytes(received)
+        tx = CMutableTransaction.stream_deserialize(BytesIO(raw_tx_bytes))
+        self.assertEqual(b2x(tx.serialize()), strHexTx)
+        self.assertEqual(b2lx(tx.GetTxid()), strHexTxHash)
+        return (segments, storage.get_raw_tx(received))
+
+    def test_hex_json(self):
+        for (strHexTx, strHexTxHash) in test_transactions():
+            (_, raw_tx) = self.roundtrip(strHexTx, strHexTxHash, False, False)
+            self.assertEqual(raw_tx, strHexTx)
+
+    def test_hex_binary(self):
+        for (strHexTx, strHexTxHash) in test_transactions():
+            (_, raw_tx) = self.roundtrip(strHexTx, strHexTxHash, False, True)
+            self.assertEqual(raw_tx, strHexTx)
+
+    def test_z85_json(self):
+        for (strHexTx, strHexTxHash) in test_transactions():
+            (segments, raw_tx) = self.roundtrip(strHexTx, strHexTxHash, True, False)
+            self.assertEqual(len(segments[0].tx_hash), 40)
+            ## the hex keeps the zero bytes padding the transaction to a multiple of 4
+            padding = -len(strHexTx) // 2 % 4
+            self.assertEqual(raw_tx, strHexTx + '00' * padding)
+
+    def test_z85_binary(self):
+        for (strHexTx, strHexTxHash) in test_transactions():
+            self.roundtrip(strHexTx, strHexTxHash, True, True)
+
+    def test_out_of_order(self):
+        for (strHexTx, strHexTxHash) in test_transactions():
+            for isZ85 in (False, True):
+                for isBinary in (False, True):
+                    self.roundtrip(strHexTx, strHexTxHash, isZ85, isBinary, order=lambda frames: frames[::-1])
+
+    def test_z85_uses_fewer_segments(self):
+        (strHexTx, strHexTxHash) = make_tx(12, outputs=40)
+        hex_segments = TxTennaSegment.tx_to_segments(GID, strHexTx, strHexTxHash, '7', 'm', False)
+        z85_segments = TxTennaSegment.tx_to_segments(GID, strHexTx, strHexTxHash, '7', 'm', True)
+        self.assertLess(len(z85_segments), len(hex_segments))
+
+    def test_lengths_cover_every_remainder(self):
+        self.assertEqual(set(len(strHexTx) // 2 % 4 for (strHexTx, _) in test_transactions()), set(range(4)))
+
+if __name__ == '__main__':
+    unittest.main()
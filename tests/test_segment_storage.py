@@ -0,0 +1,88 @@
+""" Limits of SegmentStorage on what received segments can make it keep
+"""
+import os
+import unittest
+
+import fec
+from txtenna_segment import TxTennaSegment, MAX_SEGMENT_COUNT, BINARY_FRAME_LEN
+from segment_storage import SegmentStorage, SLOT_BYTES
+
+def message_segments(size, parity):
+    text = os.urandom(size).encode('base64').replace('\n', '')
+    return (text, list(TxTennaSegment.iter_segments(1234, [text], size, 'file', '1', 'd', parity=parity)))
+
+def forged_head(payload_id, segment_count):
+    return TxTennaSegment.deserialize_from_json(
+        '{{"i":"{:016x}","t":"00","s":{},"h":"{}"}}'.format(payload_id, segment_count, 'ab' * 32))
+
+class SegmentStorageLimitsTest(unittest.TestCase):
+
+    def test_rejects_segment_count_above_cap(self):
+        storage = SegmentStorage()
+        for payload_id in range(3):
+            self.assertFalse(storage.put(forged_head(payload_id, 20000000)))
+        self.assertFalse(storage.put(forged_head(3, MAX_SEGMENT_COUNT + 1)))
+        self.assertFalse(storage.put(forged_head(4, 0)))
+        self.assertEqual(storage.stats()['payloads'], 0)
+
+    def test_rejects_sequence_number_above_cap(self):
+        storage = SegmentStorage()
+        segment = TxTennaSegment.deserialize_from_json('{"i":"0000000000000001","t":"00","c":100000000}')
+        self.assertFalse(storage.put(segment))
+        self.assertEqual(storage.stats()['payloads'], 0)
+
+    def test_slots_count_towards_max_bytes(self):
+        ## room for the slots of three heads
+        storage = SegmentStorage(max_bytes=3 * (MAX_SEGMENT_COUNT * SLOT_BYTES + 100))
+        for payload_id in range(5):
+            self.assertTrue(storage.put(forged_head(payload_id, MAX_SEGMENT_COUNT)))
+        stats = storage.stats()
+        self.assertEqual(stats['payloads'], 3)
+        self.assertGreater(stats['bytes'], 3 * MAX_SEGMENT_COUNT * SLOT_BYTES)
+        self.assertLessEqual(stats['bytes'], storage.max_bytes)
+        self.assertEqual(stats['evicted_lru'], 2)
+
+    def test_sender_refuses_too_many_segments(self):
+        text = 'A' * (180 * MAX_SEGMENT_COUNT)
+        with self.assertRaises(ValueError):
+            list(TxTennaSegment.iter_segments(1234, [text], len(text) // 4 * 3, 'file', '1', 'd'))
+
+    def test_sender_refuses_file_name_too_long_for_binary_head(self):
+        text = 'QUJD' * 100
+        with self.assertRaises(ValueError):
+            list(TxTennaSegment.iter_segments(1234, [text], 300, 'f' * 300, '1', 'd', isBinary=True, codec='z'))
+
+        segments = list(TxTennaSegment.iter_segments(1234, [text], 300, 'f' * 150, '1', 'd', isBinary=True, codec='z'))
+        frames = [segment.serialize_to_binary() for segment in segments]
+        self.assertLessEqual(max(len(frame) for frame in frames), BINARY_FRAME_LEN)
+        storage = SegmentStorage()
+        for frame in frames:
+            storage.put(TxTennaSegment.deserialize_from_json(frame))
+        self.assertTrue(storage.is_complete(segments[0].payload_id))
+        self.assertEqual(storage.get_transaction_id(segments[0].payload_id), 'f' * 150)
+        self.assertEqual(storage.get_payload_bytes(storage.get(segments[0].payload_id)), 'ABC' * 100)
+
+class SegmentStorageParityTest(unittest.TestCase):
+
+    def test_recovers_lost_segments_of_each_group(self):
+        (text, segments) = message_segments(30000, 2)
+        count = segments[0].segment_count
+        lost = set([5, 9, fec.FEC_GROUP + 1, count - 1])
+        storage = SegmentStorage()
+        for segment in segments:
+            if segment.is_parity() or segment.sequence_num not in lost:
+                storage.put(TxTennaSegment.deserialize_from_json(segment.serialize_to_json()))
+        payload_id = segments[0].payload_id
+        self.assertTrue(storage.is_complete(payload_id))
+        self.assertEqual(storage.stats()['recovered'], len(lost))
+        self.assertEqual(storage.get_payload_bytes(storage.get(payload_id)), text.decode('base64'))
+
+    def test_parity_frames_fit_the_data_frame_budget(self):
+        ## a seven digit length in the "l" field of each parity segment
+        (_, segments) = message_segments(1500000, 100)
+        (_, plain) = message_segments(1500000, 0)
+        budget = max(len(segment.serialize_to_json()) for segment in plain)
+        self.assertLessEqual(max(len(segment.serialize_to_json()) for segment in segments), budget)
+
+if __name__ == '__main__':
+    unittest.main()
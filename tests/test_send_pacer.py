@@ -0,0 +1,47 @@
+""" SendPacer pacing of sends on their callbacks
+"""
+import threading
+import unittest
+from time import time
+
+from send_pacer import SendPacer
+
+class SendPacerTest(unittest.TestCase):
+
+    def pacer(self):
+        return SendPacer(initial_backoff=0.01, callback_timeout=5.0)
+
+    def test_waits_for_callback(self):
+        pacer = self.pacer()
+        callback = pacer.wrap(lambda correlation_id, **kwargs: None)
+        self.assertEqual(pacer.send(lambda: 1), 1)
+        timer = threading.Timer(0.2, callback, args=(1,), kwargs={'success': True})
+        timer.start()
+        start = time()
+        self.assertEqual(pacer.send(lambda: 2), 2)
+        self.assertGreaterEqual(time() - start, 0.15)
+        self.assertEqual(pacer.stats()['succeeded'], 1)
+
+    def test_retries_rejected_send(self):
+        pacer = self.pacer()
+        results = [None, None, 3]
+        self.assertEqual(pacer.send(lambda: results.pop(0)), 3)
+        self.assertEqual(pacer.stats()['rejected'], 2)
+        self.assertGreater(pacer.stats()['delay'], 0)
+
+    def test_send_error_does_not_stall_next_send(self):
+        pacer = self.pacer()
+        def fail():
+            raise ValueError("payload too long")
+        with self.assertRaises(ValueError):
+            pacer.send(fail)
+        self.assertEqual(pacer.stats()['rejected'], 1)
+        self.assertEqual(pacer.stats()['delay'], 0.01)
+
+        start = time()
+        self.assertEqual(pacer.send(lambda: 4), 4)
+        self.assertLess(time() - start, 1.0)
+        self.assertEqual(pacer.stats()['timeouts'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+'''
+Single owner of the goTenna radio for outbound messages
+
+Every broadcast and private message is queued here by priority and sent in
+order by one scheduler thread, so time sensitive transaction relays and
+confirmations are not held up behind bulk Blocksat data.
+'''
+
+import itertools
+import traceback
+from threading import Thread
+import Queue
+
+PRIORITY_CONFIRMATION = 0  ## confirmation replies to transaction senders
+PRIORITY_TRANSACTION = 1   ## bitcoin transaction segments
+PRIORITY_MESSAGE = 2       ## messages entered at the command line
+PRIORITY_DATA = 3          ## bulk message data, eg. from Blocksat
+
+class TransmitScheduler(object):
+
+    def __init__(self):
+        self.__queue = Queue.PriorityQueue()
+        self.__sequence = itertools.count()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def put(self, priority, send_func, *args):
+        """ Queue send_func(*args) to be run by the scheduler thread
+
+        Lower priorities are sent first, equal priorities in the order queued.
+        """
+        self.__queue.put((priority, next(self.__sequence), send_func, args))
+
+    def depth(self):
+        return self.__queue.qsize()
+
+    def join(self):
+        """ Wait until every queued message has been sent
+        """
+        self.__queue.join()
+
+    def __run(self):
+        while True:
+            (_, _, send_func, args) = self.__queue.get()
+            try:
+                send_func(*args)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                self.__queue.task_done()
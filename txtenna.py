@@ -7,20 +7,35 @@ import sys # To quit
 import os
 import traceback
 import logging
-import requests
-import json
-from threading import Thread
-from time import sleep
+import threading
+from threading import Thread, Lock
+from time import sleep, time
 import random
 import string
 import binascii
+import md5
 import goTenna # The goTenna API
 from segment_storage import SegmentStorage
-from txtenna_segment import TxTennaSegment
+from segment_journal import SegmentJournal
+from seen_filter import SeenFilter
+from dir_watcher import DirectoryWatcher
+from broadcast_index import BroadcastIndex, BROADCAST_INDEX_NAME
+from payload_stream import PayloadStreams
+import metrics
+from output_sink import PipeWriter, PipeSink, FileSink
+from nack import SentSegmentCache, RetransmitRequester, deserialize_nack
+from confirmation_tracker import ConfirmationTracker
+from online_poller import OnlineConfirmationPoller
+from rpc_pool import RPCPool
+from txtenna_segment import TxTennaSegment, BINARY_VERSION
+from send_pacer import SendPacer
+from segment_forwarder import SegmentForwarder
+from ingest_queue import IngestQueue, OVERFLOW_POLICIES, OVERFLOW_DROP_NEWEST
+from tx_scheduler import TransmitScheduler, PRIORITY_CONFIRMATION, PRIORITY_TRANSACTION, PRIORITY_MESSAGE, PRIORITY_DATA
 from io import BytesIO
 import httplib
 import struct
-import zlib
+import compression
 
 # For SPI connection only, set SPI_CONNECTION to true with proper SPI settings
 SPI_CONNECTION = False
@@ -42,22 +57,75 @@ except ImportError:
 
 # Import support for bitcoind RPC interface
 import bitcoin
-import bitcoin.rpc
-from bitcoin.core import x, lx, b2x, b2lx, CMutableTxOut, CMutableTransaction
+from bitcoin.core import lx, b2x, b2lx, CMutableTxOut, CMutableTransaction
 from bitcoin.wallet import CBitcoinAddress
 bitcoin.SelectParams('mainnet')
 
 TXTENNA_GATEWAY_GID = 2573394689
 
+## segments of one broadcast queued for the radio at a time
+SEND_WINDOW = 64
+
+BROADCASTS_SENT = metrics.counter('txtenna_broadcasts_sent_total', 'Broadcast messages, mostly segments, handed to the radio')
+PRIVATE_SENT = metrics.counter('txtenna_private_sent_total', 'Private messages, eg. confirmations and NACKs, handed to the radio')
+SEGMENTS_RECEIVED = metrics.counter('txtenna_segments_received_total', 'Segments received and stored for reassembly')
+DUPLICATES_RECEIVED = metrics.counter('txtenna_duplicate_segments_total', 'Segments received again and ignored')
+SEND_LATENCY = metrics.histogram('txtenna_send_latency_seconds', 'Time from handing a message to the radio to its send callback')
+
+def make_payload(frame):
+    """ SDK payload to send frame: a BinaryPayload for binary segments, which hold any byte, otherwise a TextPayload
+    """
+    if frame[:1] == chr(BINARY_VERSION):
+        return goTenna.payload.BinaryPayload(frame)
+    return goTenna.payload.TextPayload(frame)
+
+def payload_frame(payload):
+    """ The frame sent in a received SDK payload, see make_payload
+    """
+    binary_data = getattr(payload, 'binary_data', None)
+    if binary_data is not None:
+        return str(binary_data)
+    return str(payload.message)
+
+def payload_key(head):
+    """ Key of the payload started by head in the seen filter
+
+    Payload ids are derived from the sender's GID and message index, which starts
+    again at 0 when the sender restarts, so the hash or file name, segment count
+    and first segment of the payload tell apart payloads sent with the same id.
+    """
+    return ('payload', head.payload_id, head.get_hex_tx_hash(), head.segment_count, md5.new(str(head.payload)).digest())
+
+def supports_binary_payloads():
+    return hasattr(goTenna.payload, 'BinaryPayload')
+
+def gotenna_transport(sdk_token, event_callback):
+    """ Create the goTenna SDK driver for a USB or SPI connected radio
+    """
+    if not SPI_CONNECTION:
+        return goTenna.driver.Driver(sdk_token=sdk_token, gid=None,
+                                     settings=None,
+                                     event_callback=event_callback)
+    return goTenna.driver.SpiDriver(SPI_BUS_NO, SPI_CHIP_NO, SPI_REQUEST, SPI_READY,
+                                    sdk_token, None, None, event_callback)
+
 class goTennaCLI(cmd.Cmd):
     """ CLI handler function
+
+    transport_factory(sdk_token, event_callback) creates the radio driver, by
+    default the goTenna SDK driver. See mesh_transport.SimulatedMesh.
     """
-    def __init__(self):
+    def __init__(self, transport_factory=gotenna_transport):
+        self.transport_factory = transport_factory
         self.api_thread = None
         self.status = {}
         cmd.Cmd.__init__(self)
         self.prompt = 'txTenna>'
         self.in_flight_events = {}
+        ## when each message in in_flight_events was handed to the radio
+        self.in_flight_times = {}
+        ## held while a message is handed to the radio and its entries added, and by the callback removing them
+        self.in_flight_lock = threading.RLock()
         self._set_frequencies = False
         self._set_tx_power = False
         self._set_bandwidth = False
@@ -69,11 +137,32 @@ class goTennaCLI(cmd.Cmd):
         self._awaiting_disconnect_after_fw_update = [False]
         self.messageIdx = 0
         self.local = False
+        self.use_z85 = False
+        self.use_binary = False
+        self.fec_parity = 0
+        self.zmq_url = 'tcp://127.0.0.1:28332'
+        self.rpc = RPCPool()
+        self.confirmation_tracker = None
+        self._confirmation_tracker_lock = Lock()
+        self.online_poller = OnlineConfirmationPoller(self.send_block_height)
         self.segment_storage = SegmentStorage()
+        self.payload_streams = PayloadStreams(self.segment_storage, self.open_message_sink)
+        self.seen = SeenFilter()
+        self.sent_segments = None
+        self.nack_requester = None
+        self.send_pacer = SendPacer()
+        self.tx_scheduler = TransmitScheduler()
+        self.ingest_queue = IngestQueue(self.handle_message)
+        self.segment_forwarder = SegmentForwarder()
         self.send_dir = None
+        self.broadcast_index_path = None
+        self.broadcast_index = None
         self.receive_dir = None
         self.watch_dir_thread = None
         self.pipe_file = None
+        self.pipe_writer = None
+        self._pipe_writer_lock = Lock()
+        self.register_metrics()
 
     def precmd(self, line):
         if not self.api_thread\
@@ -89,14 +178,7 @@ class goTennaCLI(cmd.Cmd):
             print("To change SDK tokens, restart the sample app.")
             return
         try:
-            if not SPI_CONNECTION:
-                self.api_thread = goTenna.driver.Driver(sdk_token=rst, gid=None, 
-                                                    settings=None, 
-                                                    event_callback=self.event_callback)
-            else:
-                self.api_thread = goTenna.driver.SpiDriver(
-                                    SPI_BUS_NO, SPI_CHIP_NO, 22, 27,
-                                    rst, None, None, self.event_callback)
+            self.api_thread = self.transport_factory(rst, self.event_callback)
             self.api_thread.start()
         except ValueError:
             print("SDK token {} is not valid. Please enter a valid SDK token."
@@ -113,11 +195,9 @@ class goTennaCLI(cmd.Cmd):
         This will be invoked from the API's thread when events are received.
         """
         if evt.event_type == goTenna.driver.Event.MESSAGE:
-            try:
-                ## print(str(evt))
-                self.handle_message(evt.message)
-            except Exception:
-                traceback.print_exc()
+            ## handled by the ingest workers so the API thread is not held up
+            if not self.ingest_queue.put(evt.message):
+                print("Ingest queue full, dropped a received message")
         elif evt.event_type == goTenna.driver.Event.DEVICE_PRESENT:
             ## print(str(evt))
             if self._awaiting_disconnect_after_fw_update[0]:
@@ -178,8 +258,12 @@ class goTennaCLI(cmd.Cmd):
 
             Does nothing but print whether the method succeeded or failed.
             """
-            method = self.in_flight_events.pop(correlation_id.bytes,
-                                               'Method call')
+            with self.in_flight_lock:
+                method = self.in_flight_events.pop(correlation_id.bytes,
+                                                   'Method call')
+                sent_at = self.in_flight_times.pop(correlation_id.bytes, None)
+            if sent_at is not None:
+                SEND_LATENCY.observe(time() - sent_at)
             if success:
                 if results:
                     print("{} succeeded: {}".format(method, results))
@@ -222,6 +306,11 @@ class goTennaCLI(cmd.Cmd):
 
         Usage: send_broadcast MESSAGE
         """
+        self.tx_scheduler.put(PRIORITY_MESSAGE, self.send_broadcast, message)
+
+    def send_broadcast(self, message):
+        """ Send a broadcast message through the radio, called from the transmit scheduler thread
+        """
         if not self.api_thread.connected:
             print("No device connected")
         else:
@@ -233,17 +322,18 @@ class goTennaCLI(cmd.Cmd):
                     return "Message may not have been sent: USB connection disrupted"
                 return "Error sending message: {}".format(details)
             try:
-                method_callback = self.build_callback(error_handler)
-                payload = goTenna.payload.TextPayload(message)
+                method_callback = self.send_pacer.wrap(self.build_callback(error_handler))
+                payload = make_payload(message)
                 print("payload valid = {}, message size = {}\n".format(payload.valid, len(message)))
 
-                corr_id = self.api_thread.send_broadcast(payload, method_callback)
-                while (corr_id is None):
-                    ## try again if send_broadcast fails
-                    sleep(10)
-                    corr_id = self.api_thread.send_broadcast(payload, method_callback)
+                if isinstance(payload, goTenna.payload.TextPayload):
+                    method = 'Broadcast message: {} ({} bytes)\n'.format(message,len(message))
+                else:
+                    method = 'Broadcast binary segment ({} bytes)\n'.format(len(message))
 
-                self.in_flight_events[corr_id.bytes] = 'Broadcast message: {} ({} bytes)\n'.format(message,len(message))
+                ## waits for the previous message to be sent, and retries if send_broadcast fails
+                self.send_in_flight(lambda: self.api_thread.send_broadcast(payload, method_callback), method)
+                BROADCASTS_SENT.inc()
             except ValueError:
                 print("Message too long!")
                 return
@@ -275,6 +365,11 @@ class goTennaCLI(cmd.Cmd):
 
         MESSAGE is the message.
         """
+        self.tx_scheduler.put(PRIORITY_MESSAGE, self.send_private, rem)
+
+    def send_private(self, rem):
+        """ Send a private message through the radio, called from the transmit scheduler thread
+        """
         if not self.api_thread.connected:
             print("Must connect first")
             return
@@ -288,8 +383,8 @@ class goTennaCLI(cmd.Cmd):
             return "Error sending message: {}".format(details)
 
         try:
-            method_callback = self.build_callback(error_handler)
-            payload = goTenna.payload.TextPayload(message)
+            method_callback = self.send_pacer.wrap(self.build_callback(error_handler))
+            payload = make_payload(message)
             def ack_callback(correlation_id, success):
                 if success:
                     print("Private message to {}: delivery confirmed"
@@ -297,15 +392,127 @@ class goTennaCLI(cmd.Cmd):
                 else:
                     print("Private message to {}: delivery not confirmed, recipient may be offline or out of range"
                           .format(gid.gid_val))
-            corr_id = self.api_thread.send_private(gid, payload,
-                                                   method_callback,
-                                                   ack_callback=ack_callback,
-                                                   encrypt=self._do_encryption)
+            self.send_in_flight(
+                lambda: self.api_thread.send_private(gid, payload,
+                                                     method_callback,
+                                                     ack_callback=ack_callback,
+                                                     encrypt=self._do_encryption),
+                'Private message to {}: {}'.format(gid.gid_val, message))
         except ValueError:
             print("Message too long!")
             return
-        self.in_flight_events[corr_id.bytes]\
-            = 'Private message to {}: {}'.format(gid.gid_val, message)
+        PRIVATE_SENT.inc()
+
+    def send_in_flight(self, send_func, method):
+        """ Hand a message to the radio with send_func through send_pacer, naming it method in its callback
+
+        The callback may run on the SDK thread before send_func returns the correlation
+        id, so the in flight entries are added under in_flight_lock, which it waits for.
+        """
+        def send():
+            with self.in_flight_lock:
+                sent_at = time()
+                corr_id = send_func()
+                if corr_id is not None:
+                    self.in_flight_events[corr_id.bytes] = method
+                    self.in_flight_times[corr_id.bytes] = sent_at
+                return corr_id
+        return self.send_pacer.send(send)
+
+    def do_send_rate(self, rem):
+        """ Show the pacing of messages sent through the radio.
+
+        Usage: send_rate
+        """
+        # pylint: disable=unused-argument
+        stats = self.send_pacer.stats()
+        print("{:.2f} segments/sec, delay {:.1f}s, {} sent, {} succeeded, {} failed, {} rejected, {} timed out"
+              .format(stats['segments_per_sec'], stats['delay'], stats['sent'], stats['succeeded'],
+                      stats['failed'], stats['rejected'], stats['timeouts']))
+        print("{} messages queued for the radio".format(self.tx_scheduler.depth()))
+
+    def do_ingest_stats(self, rem):
+        """ Show the queue of received messages waiting to be handled.
+
+        Usage: ingest_stats
+        """
+        # pylint: disable=unused-argument
+        stats = self.ingest_queue.stats()
+        print("{} messages queued (peak {}), {} handled, {} dropped, latency {:.3f}s average, {:.3f}s max"
+              .format(stats['depth'], stats['peak_depth'], stats['handled'], stats['dropped'],
+                      stats['average_latency'], stats['max_latency']))
+
+    def do_forward_stats(self, rem):
+        """ Show how many received segments were forwarded to txtenna-server.
+
+        Usage: forward_stats
+        """
+        # pylint: disable=unused-argument
+        stats = self.segment_forwarder.stats()
+        print("{} segments forwarded in {} batches, {} pending, {} retries, {} rejected, {} spooled"
+              .format(stats['forwarded'], stats['batches'], stats['pending'], stats['retries'],
+                      stats['rejected'], stats['spooled']))
+
+    def do_storage_stats(self, rem):
+        """ Show the payloads being reassembled from received segments.
+
+        Usage: storage_stats
+        """
+        # pylint: disable=unused-argument
+        stats = self.segment_storage.stats()
+        print("{} payloads ({} bytes) being reassembled, {} expired, {} evicted, {} handed off, {} duplicates ignored, {} segments recovered"
+              .format(stats['payloads'], stats['bytes'], stats['evicted_expired'],
+                      stats['evicted_lru'], stats['removed'], self.seen.hits, stats['recovered']))
+
+    def register_metrics(self):
+        """ Report the depth of queues and work in progress as gauges of the metrics
+        """
+        metrics.gauge('txtenna_tx_queue_depth', 'Messages queued for the radio',
+                      self.tx_scheduler.depth)
+        metrics.gauge('txtenna_in_flight', 'Messages handed to the radio and waiting for their send callback',
+                      lambda: len(self.in_flight_times))
+        metrics.gauge('txtenna_ingest_queue_depth', 'Received messages waiting to be handled',
+                      lambda: self.ingest_queue.stats()['depth'])
+        metrics.gauge('txtenna_forward_pending', 'Segments waiting to be forwarded to txtenna-server',
+                      lambda: self.segment_forwarder.stats()['pending'])
+        metrics.gauge('txtenna_payloads_reassembling', 'Payloads being reassembled from received segments',
+                      lambda: self.segment_storage.stats()['payloads'])
+        metrics.gauge('txtenna_pipe_buffered_bytes', 'Bytes of message data waiting for the blocksat pipe',
+                      lambda: self.pipe_writer.stats()['buffered'] if self.pipe_writer is not None else 0)
+        metrics.gauge('txtenna_nack_cache_bytes', 'Bytes of segments kept to resend to receivers that report them missing',
+                      lambda: self.sent_segments.stats()['bytes'] if self.sent_segments is not None else 0)
+        metrics.gauge('txtenna_confirmations_tracked', 'Transactions whose confirmations are being tracked for their senders',
+                      lambda: self.online_poller.pending()
+                      + (self.confirmation_tracker.pending() if self.confirmation_tracker is not None else 0))
+        metrics.gauge('txtenna_threads', 'Threads running, including those handing off received payloads',
+                      threading.active_count)
+
+    def do_stats(self, rem):
+        """ Show all the statistics and metrics of the relay.
+
+        Usage: stats
+        """
+        # pylint: disable=unused-argument
+        self.do_send_rate('')
+        self.do_ingest_stats('')
+        self.do_forward_stats('')
+        self.do_storage_stats('')
+        stats = self.rpc.stats()
+        print("{} bitcoind connections ({} idle), {} requests for {} calls"
+              .format(stats['connections'], stats['idle'], stats['requests'], stats['calls']))
+        if self.pipe_writer is not None:
+            stats = self.pipe_writer.stats()
+            print("{} payloads ({} bytes) written to the pipe, {} queued ({} bytes), {} reconnects, {} failed"
+                  .format(stats['written'], stats['bytes_written'], stats['queued'], stats['buffered'],
+                          stats['reconnects'], stats['failed']))
+        print("")
+        for metric in metrics.REGISTRY.collect():
+            if metric.kind == 'histogram':
+                print("{}: {} observed, {:.3f} average, {:.3f} median, {:.3f} 95th percentile, {:.3f} max"
+                      .format(metric.name, metric.count, metric.sum / float(metric.count) if metric.count else 0.0,
+                              metric.quantile(0.5), metric.quantile(0.95), metric.max))
+            else:
+                print("{}: {}".format(metric.name, metric.samples()[0][1]))
 
     def get_device_type(self):
         return self.api_thread.device_type
@@ -380,8 +587,8 @@ class goTennaCLI(cmd.Cmd):
         Usage: rpc_sendtoaddress TX_ID
         """
         try :
-            proxy = bitcoin.rpc.Proxy()
-            r = proxy.getrawtransaction(lx(tx_id), True)
+            with self.rpc.proxy() as proxy:
+                r = proxy.getrawtransaction(lx(tx_id), True)
             print(str(r))
         except:
             traceback.print_exc()
@@ -395,118 +602,69 @@ class goTennaCLI(cmd.Cmd):
 
         ## send transaction to local bitcond
         segments = self.segment_storage.get_by_transaction_id(hash)
-        raw_tx = self.segment_storage.get_raw_tx(segments)
 
-        ## pass hex string converted to bytes
+        ## pass the transaction bytes decoded from the segments
         try :
-            proxy1 = bitcoin.rpc.Proxy()
-            raw_tx_bytes = x(raw_tx)
+            raw_tx_bytes = self.segment_storage.get_payload_bytes(segments)
+            self.segment_storage.remove_by_transaction_id(hash)
             tx = CMutableTransaction.stream_deserialize(BytesIO(raw_tx_bytes))
-            r1 = proxy1.sendrawtransaction(tx)
+            ## sent in one request with any other transactions completed at the same time
+            self.rpc.sendrawtransaction(tx.serialize())
         except :
             print("Invalid Transaction! Could not send to network.")
+            ## let a later copy of the transaction be sent again
+            self.seen.discard(('tx', hash))
             return
 
-        ## try for 30 minutes to confirm the transaction
-        for n in range(0, 30) :
-            try :
-                proxy2 = bitcoin.rpc.Proxy()
-                r2 = proxy2.getrawtransaction(r1, True)
-
-                ## send zero-conf message back to tx sender
-                confirmations = r2.get('confirmations', 0)
-                rObj = TxTennaSegment('', '', tx_hash=hash, block=confirmations)
-                arg = str(sender_gid) + ' ' + rObj.serialize_to_json()
-                self.do_send_private(arg)
-
-                print("\nSent to GID: " + str(sender_gid) + ": Transaction " + hash + " added to the mempool.")
-                break      
-            except IndexError:
-                ## tx_id not yet in the global mempool, sleep for a minute and then try again
-                sleep(60)
-                continue      
-            
-            ## wait for atleast one confirmation
-            for m in range(0, 30):
-                sleep(60) # sleep for a minute
-                try :
-                    proxy3= bitcoin.rpc.Proxy()
-                    r3 = proxy3.getrawtransaction(r1, True)
-                    confirmations = r3.get('confirmations', 0)
-                    ## keep waiting until 1 or more confirmations
-                    if confirmations > 0:
-                        break
-                except :
-                    ## unknown RPC error, but keep trying
-                    traceback.print_exc()
-
-            if confirmations > 0 :
-                ## send confirmations message back to tx sender if confirmations > 0
-                rObj = TxTennaSegment('', '', tx_hash=hash, block=confirmations)
-                arg = str(sender_gid) + ' ' + rObj.serialize_to_json()
-                self.do_send_private(arg)
-                print("\nSent to GID: " + str(sender_gid) + ", Transaction " + hash + " confirmed in " + str(confirmations) + " blocks.")
-            else :
-                print("\CTransaction from GID: " + str(sender_gid) + ", Transaction " + hash + " not confirmed after 30 minutes.")
-
-    def confirm_bitcoin_tx_online(self, hash, sender_gid, network):
-        """ confirm bitcoin transaction using default online Samourai API instance
+        if sender_gid is not None:
+            self.track_bitcoin_tx_local(hash, sender_gid)
 
-        Usage: confirm_bitcoin_tx tx_id gid network
+    def track_bitcoin_tx_local(self, hash, sender_gid):
+        """ Report the transaction to the sender once in the mempool and again once confirmed
         """
+        with self._confirmation_tracker_lock:
+            if self.confirmation_tracker is None:
+                self.confirmation_tracker = ConfirmationTracker(self.send_confirmation, self.rpc, zmq_url=self.zmq_url)
+        self.confirmation_tracker.track(hash, sender_gid)
 
-        if  network == 't' :
-            url = "https://api.samourai.io/test/v2/tx/" + hash ## default testnet txtenna-server
-        else :
-            url = "https://api.samourai.io/v2/tx/" + hash ## default txtenna-server
-        
-        try:
-            r = requests.get(url)
-            ## print(r.text)
-
-            while r.status_code != 200:
-                sleep(60) # sleep for a minute
-                r = requests.get(url)
-
-            ## send zero-conf message back to tx sender
-            rObj = TxTennaSegment('', '', tx_hash=hash, block=0)
-            arg = str(sender_gid) + ' ' + rObj.serialize_to_json()
-            self.do_send_private(arg)    
-
-            print("\nSent to GID: " + str(sender_gid) + ": Transaction " + hash + " added to the mempool.")            
-
-            r_text = "".join(r.text.split()) # remove whitespace
-            obj = json.loads(r_text)
-            while not 'block' in obj.keys():
-                sleep(60) # sleep for a minute
-                r = requests.get(url)
-                r_text = "".join(r.text.split())
-                obj = json.loads(r_text)
-
-            ## send block height message back to tx sender
-            blockheight = obj['block']['height']
-            rObj = TxTennaSegment('', '', tx_hash=hash, block=blockheight)
-            arg = str(sender_gid) + ' ' + rObj.serialize_to_json()
-            self.do_send_private(arg)
+    def send_confirmation(self, sender_gid, hash, confirmations):
+        """ Send a mempool (0) or block confirmation message back to a transaction sender
+        """
+        self._send_block_message(sender_gid, hash, confirmations)
+        if confirmations > 0:
+            print("\nSent to GID: " + str(sender_gid) + ", Transaction " + hash + " confirmed in " + str(confirmations) + " blocks.")
+        else:
+            print("\nSent to GID: " + str(sender_gid) + ": Transaction " + hash + " added to the mempool.")
 
+    def send_block_height(self, sender_gid, hash, blockheight):
+        """ Send a mempool (0) or block height message back to a transaction sender
+        """
+        self._send_block_message(sender_gid, hash, blockheight)
+        if blockheight > 0:
             print("\nSent to GID: " + str(sender_gid) + ": Transaction " + hash + " confirmed in block " + str(blockheight) + ".")
+        else:
+            print("\nSent to GID: " + str(sender_gid) + ": Transaction " + hash + " added to the mempool.")
 
-        except:
-            traceback.print_exc()
+    def _send_block_message(self, sender_gid, hash, block):
+        rObj = TxTennaSegment('', '', tx_hash=hash, block=block)
+        arg = str(sender_gid) + ' ' + rObj.serialize_to_json()
+        self.tx_scheduler.put(PRIORITY_CONFIRMATION, self.send_private, arg)
 
-    def create_output_data_struct(self, data):
-        """Create the output data structure generated by the blocksat receiver
+    def confirm_bitcoin_tx_online(self, hash, sender_gid, network):
+        """ confirm bitcoin transaction using default online Samourai API instance
 
-        The "Protocol Sink" block of the blocksat-rx application places the incoming
-        API data into output structures. This function creates the exact same
-        structure that the blocksat-rx application would.
+        Usage: confirm_bitcoin_tx tx_id gid network
+        """
 
-        Args:
-            data : Sequence of bytes to be placed in the output structure
+        ## the shared poller sends the mempool and block height messages back to the tx sender
+        self.online_poller.track(hash, sender_gid, network)
 
-        Returns:
-            Output data structure as sequence of bytes
+    def create_output_data_header(self, length):
+        """Create the output data structure header generated by the blocksat receiver
 
+        The "Protocol Sink" block of the blocksat-rx application places the incoming
+        API data into output structures, this header followed by length bytes of data.
+        The header and the data are written with one vectored write, see output_sink.py.
         """
 
         # Header of the output data structure that the Blockstream Satellite Receiver
@@ -517,57 +675,160 @@ class goTennaCLI(cmd.Cmd):
                              '\xa5\xd6\x00W}M\xa6TO\xda7\xfaeu:\xac\xdc'
 
         # Struct is composed of a delimiter and the message length
-        out_data_header = struct.pack(OUT_DATA_HEADER_FORMAT,
-                                    OUT_DATA_DELIMITER,
-                                    len(data))
+        return struct.pack(OUT_DATA_HEADER_FORMAT,
+                           OUT_DATA_DELIMITER,
+                           length)
 
-        # Final output data structure
-        out_data = out_data_header + data
-
-        return out_data            
-            
     def receive_message_from_gateway(self, filename):
         """ 
         Receive message data from a mesh gateway node
 
+        The data was written out as its segments arrived, this writes the rest of it.
+
         Usage: receive_message_from_gateway filename
         """ 
 
-        ## send transaction to local blocksat reader pipe
         segments = self.segment_storage.get_by_transaction_id(filename)
-        raw_data = self.segment_storage.get_raw_tx(segments).encode("utf-8")
-
-        decoded_data = zlib.decompress(raw_data.decode('base64'))
+        size = self.payload_streams.finish(segments[0].payload_id)
+        print("Message Data received for [" + filename + "] ( " + str(size) + " bytes )\n")
 
-        deliminted_data = self.create_output_data_struct(decoded_data)
-
-        ## send the data to the blocksat pipe
-        try :
-            print("Message Data received for [" + filename + "] ( " + str(len(decoded_data)) + " bytes ) :\n" + str(decoded_data) + "\n")
-        except UnicodeDecodeError :
-            print("Binary Data received for [" + filename + "] ( " + str(len(decoded_data)) + " bytes )\n")
-        
+    def open_message_sink(self, filename):
+        """ Sink for the message data of filename: the blocksat pipe, or a file in the receive directory
+        """
         if not self.pipe_file is None and os.path.exists(self.pipe_file) is True :
-            # Open pipe and write raw data to it
-            pipe_f = os.open(self.pipe_file, os.O_RDWR)
-            os.write(pipe_f, deliminted_data)
+            with self._pipe_writer_lock:
+                if self.pipe_writer is None or self.pipe_writer.pipe_file != self.pipe_file:
+                    ## kept open by its thread between payloads
+                    self.pipe_writer = PipeWriter(self.pipe_file, self.create_output_data_header)
+            return PipeSink(self.pipe_writer)
         elif not self.receive_dir is None and os.path.exists(self.receive_dir) is True :
-            # Create file
-            dump_f = os.open(os.path.join(self.receive_dir, filename), os.O_CREAT | os.O_RDWR)
-            os.write(dump_f, decoded_data)
+            return FileSink(os.path.join(self.receive_dir, filename))
         else :
-            print("ERROR: Could not save data. No pipe found at [" + self.pipe_file + "] and no receive directory found at [" + self.receive_dir +"]\n")
+            print("ERROR: Could not save data. No pipe found at [" + str(self.pipe_file) + "] and no receive directory found at [" + str(self.receive_dir) +"]\n")
+            return None
+
+    def serialize_segment(self, segment):
+        """ Serialize a segment to send over the mesh, in the binary format if enabled
+        """
+        if self.use_binary:
+            return segment.serialize_to_binary()
+        return segment.serialize_to_json()
+
+    def resume_received_payloads(self):
+        """ Hand off message data and relay transactions that were reassembled, but not handed off, before a restart
+
+        The senders of resumed transactions are not known, so no confirmations are sent back for them.
+        """
+        for payload_id in self.segment_storage.get_complete_payload_ids():
+            network = self.segment_storage.get_network(payload_id)
+            if not self.segment_storage.claim_complete(payload_id):
+                continue
+            if network == 'd':
+                self.mark_handled(payload_id)
+                filename = self.segment_storage.get_transaction_id(payload_id)
+                t = Thread(target=self.receive_message_from_gateway, args=(filename,))
+                t.start()
+                continue
+
+            tx_id = self.segment_storage.get_transaction_id(payload_id)
+            print("Relaying transaction " + tx_id + " reassembled before a restart")
+            if not self.local:
+                ## the segments may not have been forwarded to txtenna-server before the restart
+                for segment in self.segment_storage.get(payload_id):
+                    self.segment_forwarder.forward(segment)
+            self.relay_complete_tx(payload_id, tx_id, None, network)
+
+    def mark_handled(self, payload_id):
+        """ Remember that the complete payload_id was handed off, to ignore its segments when heard again
+        """
+        self.seen.add(('payload', payload_id))
+        self.seen.add(payload_key(self.segment_storage.get_head(payload_id)))
+
+    def is_handled(self, segment):
+        """ True for a segment of a payload that was already handed off, eg. heard again from a repeated broadcast
+
+        A head segment is only ignored if it starts the same payload. Other segments
+        are ignored for an id that was handed off unless a new payload with that id
+        is being reassembled, eg. from a sender that restarted.
+        """
+        if segment.sequence_num == 0 and not segment.is_parity() and segment.segment_count is not None:
+            return self.seen.seen(payload_key(segment))
+        return not self.segment_storage.has(segment.payload_id) and self.seen.seen(('payload', segment.payload_id))
+
+    def broadcast_segments(self, segments, priority):
+        """ Queue segments for broadcast, keeping them in sent_segments, if any, to resend those that receivers report missing
+
+        At most SEND_WINDOW segments are queued at a time, the next one is taken from
+        segments once the radio has sent an earlier one, so a generator of the
+        segments of a large file is only read as fast as they are sent.
+        """
+        window = threading.Semaphore(SEND_WINDOW)
+        count = 0
+        for seg in segments :
+            frame = self.serialize_segment(seg)
+            if self.sent_segments is not None :
+                if count == 0 :
+                    self.sent_segments.start(seg.payload_id, priority)
+                self.sent_segments.add(seg.payload_id, seg.sequence_num, frame)
+            window.acquire()
+            self.tx_scheduler.put(priority, self.send_window_broadcast, frame, window)
+            count += 1
+        return count
+
+    def send_window_broadcast(self, frame, window):
+        """ Broadcast a segment queued by broadcast_segments, making room in its window for the next one
+        """
+        try:
+            self.send_broadcast(frame)
+        finally:
+            window.release()
+
+    def send_nack(self, sender_gid, nack):
+        """ Ask the sender of an incomplete payload to resend the segments listed in nack
+        """
+        print("\nRequesting missing segments from GID: " + str(sender_gid) + ": " + nack)
+        self.tx_scheduler.put(PRIORITY_CONFIRMATION, self.send_private, str(sender_gid) + ' ' + nack)
+
+    def handle_nack(self, nack, sender_gid):
+        """ Resend the segments of one of our broadcasts that a receiver reports missing
+        """
+        (payload_id, missing) = nack
+        if self.sent_segments is None:
+            print("Ignoring NACK from GID: " + str(sender_gid) + ", resending is not enabled with --nack_cache_bytes")
+            return
+        resend = self.sent_segments.get(payload_id, missing)
+        if resend is None:
+            print("Ignoring NACK from GID: " + str(sender_gid) + " for unknown payload " + payload_id)
+            return
+        (priority, frames) = resend
+        print("Resending {} of {} missing segments of payload {} to GID: {}".format(len(frames), len(missing), payload_id, sender_gid))
+        for frame in frames :
+            self.tx_scheduler.put(priority, self.send_broadcast, frame)
 
     def handle_message(self, message):
         """ handle a txtenna message received over the mesh network
 
         Usage: handle_message message
         """
-        payload = str(message.payload.message)
-        print("received transaction payload: " + payload)
+        payload = payload_frame(message.payload)
+        nack = deserialize_nack(payload)
+        if nack is not None:
+            self.handle_nack(nack, message.sender.gid_val)
+            return
 
         segment = TxTennaSegment.deserialize_from_json(payload)
-        self.segment_storage.put(segment)
+        print("received transaction payload: " + repr(segment))
+
+        if segment.block is None:
+            ## segments of a payload that was already handed off, or already received
+            ## for one still being reassembled, eg. from a repeated broadcast
+            if self.is_handled(segment) or not self.segment_storage.put(segment):
+                print("Ignoring duplicate segment {} of payload {}".format(segment.sequence_num, segment.payload_id))
+                DUPLICATES_RECEIVED.inc()
+                return
+            SEGMENTS_RECEIVED.inc()
+            if self.nack_requester is not None:
+                self.nack_requester.seen(segment.payload_id, message.sender.gid_val)
         network = self.segment_storage.get_network(segment.payload_id)
 
         ## process incoming transaction confirmation from another server
@@ -577,46 +838,67 @@ class goTennaCLI(cmd.Cmd):
             print("\nTransaction " + segment.payload_id + " added to the the mem pool")
         elif (network is 'd'):
             ## process message data
-            if (self.segment_storage.is_complete(segment.payload_id)):
+            if (self.segment_storage.claim_complete(segment.payload_id)):
+                self.mark_handled(segment.payload_id)
                 filename = self.segment_storage.get_transaction_id(segment.payload_id)
                 t = Thread(target=self.receive_message_from_gateway, args=(filename,))
                 t.start()
+            else:
+                ## decode and write out the data received so far
+                self.payload_streams.update(segment.payload_id)
         else:
             ## process incoming tx segment
-            if not self.local :
-                headers = {u'content-type': u'application/json'}
-                url = "https://api.samouraiwallet.com/v2/txtenna/segments" ## default txtenna-server
-                r = requests.post(url, headers= headers, data=payload)
-                print(r.text)
-
-            if (self.segment_storage.is_complete(segment.payload_id)):
-                sender_gid = message.sender.gid_val
-                tx_id = self.segment_storage.get_transaction_id(segment.payload_id)
-
-                ## check for confirmed transaction in a new thread
-                if (self.local) :
-                    t = Thread(target=self.confirm_bitcoin_tx_local, args=(tx_id, sender_gid))
-                else :
-                    t = Thread(target=self.confirm_bitcoin_tx_online, args=(tx_id, sender_gid, network))
-                t.start()
+            tx_id = self.segment_storage.get_transaction_id(segment.payload_id)
+            if not self.local and (tx_id is None or not self.seen.seen(('tx', tx_id))):
+                self.segment_forwarder.forward(segment)
+
+            if (self.segment_storage.claim_complete(segment.payload_id)):
+                self.relay_complete_tx(segment.payload_id, tx_id, message.sender.gid_val, network)
+
+    def relay_complete_tx(self, payload_id, tx_id, sender_gid, network):
+        """ Relay the complete transaction payload_id, sending its confirmations to sender_gid unless None
+        """
+        self.mark_handled(payload_id)
+        if not self.seen.add(('tx', tx_id)):
+            ## relayed from another sender or broadcast again, so only add this
+            ## sender to the replies of the confirmation already being watched
+            print("Transaction " + tx_id + " was already relayed, sender " + str(sender_gid) + " will be sent its confirmations")
+            self.segment_storage.remove(payload_id)
+            if sender_gid is None:
+                return
+            if self.local:
+                self.track_bitcoin_tx_local(tx_id, sender_gid)
+            else:
+                self.confirm_bitcoin_tx_online(tx_id, sender_gid, network)
+            return
+
+        ## check for confirmed transaction
+        if (self.local) :
+            t = Thread(target=self.confirm_bitcoin_tx_local, args=(tx_id, sender_gid))
+            t.start()
+        else :
+            ## no need to wait for more segments of this payload
+            self.segment_forwarder.flush(payload_id)
+            if sender_gid is not None:
+                self.confirm_bitcoin_tx_online(tx_id, sender_gid, network)
+            ## the segments were already forwarded to txtenna-server
+            self.segment_storage.remove(payload_id)
 
     def do_mesh_broadcast_rawtx(self, rem):
         """ 
         Broadcast the raw hex of a Bitcoin transaction and its transaction ID over mainnet or testnet. 
         A local copy of txtenna-server must be configured to support the selected network.
+        The transaction is Z85 encoded if txtenna.py was started with --z85.
 
         Usage: mesh_broadcast_tx RAW_HEX TX_ID NETWORK(m|t)
 
         eg. txTenna> mesh_broadcast_rawtx 01000000000101bf6c3ed233e8700b42c1369993c2078780015bab7067b9751b7f49f799efbffd0000000017160014f25dbf0eab0ba7e3482287ebb41a7f6d361de6efffffffff02204e00000000000017a91439cdb4242013e108337df383b1bf063561eb582687abb93b000000000017a9148b963056eedd4a02c91747ea667fc34548cab0848702483045022100e92ce9b5c91dbf1c976d10b2c5ed70d140318f3bf2123091d9071ada27a4a543022030c289d43298ca4ca9d52a4c85f95786c5e27de5881366d9154f6fe13a717f3701210204b40eff96588033722f487a52d39a345dc91413281b31909a4018efb330ba2600000000 94406beb94761fa728a2cde836ca636ecd3c51cbc0febc87a968cb8522ce7cc1 m
         """
 
-        ## TODO: test Z85 binary encoding and add as an option
         (strHexTx, strHexTxHash, network) = rem.split(" ")
         gid = self.api_thread.gid.gid_val
-        segments = TxTennaSegment.tx_to_segments(gid, strHexTx, strHexTxHash, str(self.messageIdx), network, False)
-        for seg in segments :
-            self.do_send_broadcast(seg.serialize_to_json())
-            sleep(10)
+        segments = TxTennaSegment.tx_to_segments(gid, strHexTx, strHexTxHash, str(self.messageIdx), network, self.use_z85, self.use_binary)
+        self.broadcast_segments(segments, PRIORITY_TRANSACTION)
         self.messageIdx = (self.messageIdx+1) % 9999
 
     def do_rpc_getbalance(self, rem) :
@@ -626,8 +908,8 @@ class goTennaCLI(cmd.Cmd):
         Usage: rpc_getbalance
         """
         try :
-            proxy = bitcoin.rpc.Proxy()
-            balance = proxy.getbalance()
+            with self.rpc.proxy() as proxy:
+                balance = proxy.getbalance()
             print("getbalance: " + str(balance))
         except Exception: # pylint: disable=broad-except
             traceback.print_exc()     
@@ -639,8 +921,7 @@ class goTennaCLI(cmd.Cmd):
         Usage: rpc_sendrawtransaction RAW_TX_HEX
         """
         try :
-            proxy = bitcoin.rpc.Proxy()
-            r = proxy.sendrawtransaction(hex)
+            r = self.rpc.call('sendrawtransaction', hex)
             print("sendrawtransaction: " + str(r))
         except Exception: # pylint: disable=broad-except
             traceback.print_exc()
@@ -652,9 +933,9 @@ class goTennaCLI(cmd.Cmd):
         Usage: rpc_sendtoaddress ADDRESS SATS
         """
         try:
-            proxy = bitcoin.rpc.Proxy()
             (addr, amount) = rem.split()
-            r = proxy.sendtoaddress(addr, amount)
+            with self.rpc.proxy() as proxy:
+                r = proxy.sendtoaddress(addr, amount)
             print("sendtoaddress, transaction id: " + str(r["hex"]))
         except Exception: # pylint: disable=broad-except
             traceback.print_exc() 
@@ -670,7 +951,6 @@ class goTennaCLI(cmd.Cmd):
         """
         try:
 
-            proxy = bitcoin.rpc.Proxy()
             (addr, sats, network) = rem.split()
 
             # Create the txout. This time we create the scriptPubKey from a Bitcoin
@@ -679,8 +959,9 @@ class goTennaCLI(cmd.Cmd):
 
             # Create the unsigned transaction.
             unfunded_transaction = CMutableTransaction([], [txout])
-            funded_transaction = proxy.fundrawtransaction(unfunded_transaction)
-            signed_transaction = proxy.signrawtransaction(funded_transaction["tx"])
+            with self.rpc.proxy() as proxy:
+                funded_transaction = proxy.fundrawtransaction(unfunded_transaction)
+                signed_transaction = proxy.signrawtransaction(funded_transaction["tx"])
             txhex = b2x(signed_transaction["tx"].serialize())
             txid = b2lx(signed_transaction["tx"].GetTxid())
             print("sendtoaddress_mesh (tx, txid, network): " + txhex + ", " + txid, ", " + network)
@@ -699,7 +980,8 @@ class goTennaCLI(cmd.Cmd):
             ## json_outpoints = [{'txid':b2lx(outpoint.hash), 'vout':outpoint.n}
             ##              for outpoint in vin_outpoints]
             ## print(str(json_outpoints))
-            proxy.lockunspent(False, vin_outpoints)
+            with self.rpc.proxy() as proxy:
+                proxy.lockunspent(False, vin_outpoints)
             
         except Exception: # pylint: disable=broad-except
             ## TODO: figure out why this is happening
@@ -715,37 +997,58 @@ class goTennaCLI(cmd.Cmd):
         """
 
         if (send_dir is not None):
+            ## remember what was broadcast so a restart only sends new or changed files
+            index_path = self.broadcast_index_path or os.path.join(send_dir, BROADCAST_INDEX_NAME)
+            try:
+                self.broadcast_index = BroadcastIndex(index_path)
+            except (IOError, OSError) as e:
+                print("Could not open broadcast index " + index_path + ", all files will be broadcast: " + str(e))
+
             #start new thread to watch directory
             self.watch_dir_thread = Thread(target=self.watch_messages, args=(send_dir,))
             self.watch_dir_thread.start()
 
     def watch_messages(self, send_dir):
-        
-        before = {}
-        while os.path.exists(send_dir):
-            sleep (10)
-            after = dict ([(f, None) for f in os.listdir (send_dir)])
-            new_files = [f for f in after if not f in before]
-            if new_files:
-                self.broadcast_message_files(send_dir, new_files)
-            before = after
+        """ Broadcast each file in send_dir once it has been completely written, until send_dir is removed
+        """
+        DirectoryWatcher(send_dir, self.broadcast_message_files).run()
 
     def broadcast_message_files(self, directory, filenames):
         for filename in filenames:
+            entry = None
+            if self.broadcast_index is not None:
+                try:
+                    entry = self.broadcast_index.check(filename, directory+"/"+filename)
+                except (IOError, OSError):
+                    ## removed since it was listed
+                    continue
+                if entry is None:
+                    print("Already broadcast ",directory+"/"+filename)
+                    continue
+
             print("Broadcasting ",directory+"/"+filename)
-            f = open(directory+"/"+filename,'r')
-            message_data = f.read()
-            f.close
-            
-            ## binary to ascii encoding and strip out newlines
-            encoded = zlib.compress(message_data, 9).encode('base64').replace('\n','')
-            print("[\n" + encoded.decode() + "\n]")
+            ## compress with whichever codec does best, reading the file a chunk at a time
+            with open(directory+"/"+filename,'rb') as f:
+                (codec, compressed, size) = compression.compress_file(f)
+                print("Compressed {} bytes to {} with codec '{}'".format(f.tell(), size, codec))
+
+            ## binary to ascii encoding, a whole number of base64 units at a time, without newlines
+            chunks = (binascii.b2a_base64(chunk).rstrip('\n') for chunk in iter(lambda: compressed.read(48 * 1024), b''))
 
             gid = self.api_thread.gid.gid_val
-            segments = TxTennaSegment.tx_to_segments(gid, encoded, filename, str(self.messageIdx), "d", False)
-            for seg in segments :
-                self.do_send_broadcast(seg.serialize_to_json())
-                sleep(10)
+            segments = TxTennaSegment.iter_segments(gid, chunks, size, filename, str(self.messageIdx), "d", False, self.use_binary, self.fec_parity, codec)
+            try:
+                count = self.broadcast_segments(segments, PRIORITY_DATA)
+            except ValueError as e:
+                ## eg. too large to send, or a file name too long for a binary head segment
+                print("Could not broadcast " + directory + "/" + filename + ": " + str(e))
+                continue
+            finally:
+                compressed.close()
+            print("Queued {} segments for broadcast".format(count))
+            if entry is not None:
+                ## recorded once the last segment has been handed to the radio
+                self.tx_scheduler.put(PRIORITY_DATA, self.broadcast_index.add, entry)
             self.messageIdx = (self.messageIdx+1) % 9999
 
 
@@ -769,15 +1072,87 @@ def run_cli():
                         help="Use this computer as an internet connected transaction gateway with a default GID")
     parser.add_argument("--local", action="store_true",
                         help="Use local bitcoind to confirm and broadcast transactions")
+    parser.add_argument("--zmq", default='tcp://127.0.0.1:28332',
+                        help="bitcoind zmqpubhashblock/zmqpubrawtx address used with --local to track confirmations " +
+                        "(default: tcp://127.0.0.1:28332)")
+    parser.add_argument("--z85", action="store_true",
+                        help="Send transactions with the more compact Z85 encoding instead of hex")
+    parser.add_argument("--binary", action="store_true",
+                        help="Send segments in the compact binary format, as SDK binary payloads, instead of JSON")
+    parser.add_argument("--fec_parity", type=int, default=0,
+                        help="Add this many parity segments for each group of 64 segments of message data, " +
+                        "so that as many lost segments can be recovered (default: 0)")
+    parser.add_argument("--nack_timeout", type=int, default=0,
+                        help="Seconds without a new segment of an incomplete payload before asking its sender " +
+                        "to resend the missing segments (default: 0, never ask)")
+    parser.add_argument("--nack_cache_bytes", type=int, default=0,
+                        help="Keep up to this many bytes of the segments recently broadcast, to resend those that " +
+                        "receivers using --nack_timeout report missing (default: 0, never resend)")
     parser.add_argument("--send_dir",
                         help="Broadcast message data from files in this directory")
+    parser.add_argument("--broadcast_index",
+                        help="File recording the files already broadcast from --send_dir, so they are not sent again " +
+                        "after a restart (default: .txtenna-broadcast-index in --send_dir)")
     parser.add_argument("--receive_dir",
                         help="Write files from received message data in this directory")
+    parser.add_argument("--max_payloads", type=int, default=1000,
+                        help="Maximum number of incomplete payloads kept while waiting for their segments (default: 1000)")
+    parser.add_argument("--max_payload_bytes", type=int, default=16*1024*1024,
+                        help="Maximum bytes of segment data kept for incomplete payloads (default: 16 MB)")
+    parser.add_argument("--payload_ttl", type=int, default=3600,
+                        help="Seconds to keep a payload that receives no new segments (default: 3600)")
+    parser.add_argument("--journal",
+                        help="Keep received segments in this journal file so incomplete payloads survive a restart")
+    parser.add_argument("--ingest_workers", type=int, default=2,
+                        help="Number of threads handling received messages (default: 2)")
+    parser.add_argument("--ingest_depth", type=int, default=1000,
+                        help="Maximum number of received messages waiting to be handled (default: 1000)")
+    parser.add_argument("--ingest_overflow", choices=OVERFLOW_POLICIES, default=OVERFLOW_DROP_NEWEST,
+                        help="What to do with received messages when the queue is full (default: drop_newest)")
+    parser.add_argument("--forward_window", type=float, default=0.5,
+                        help="Seconds to wait for more segments of a payload before forwarding them to txtenna-server (default: 0.5)")
+    parser.add_argument("--spool_dir",
+                        help="Keep segments that could not be forwarded to txtenna-server in this directory until they can be")
+    parser.add_argument("--metrics_port", type=int,
+                        help="Serve metrics in the Prometheus text format at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--metrics_file",
+                        help="Write metrics in the Prometheus text format to this file every 15 seconds, " +
+                        "eg. for the node_exporter textfile collector")
     parser.add_argument('-p', '--pipe',
                         default='/tmp/blocksat/api',
                         help='Pipe on which relayed message data is written out to ' +
                         '(default: /tmp/blocksat/api)')
     args = parser.parse_args()  
+    if args.binary and not supports_binary_payloads():
+        parser.error("--binary needs a goTenna SDK that sends binary payloads")
+
+    ## export metrics to Prometheus
+    if args.metrics_port is not None:
+        metrics.start_http_server(args.metrics_port)
+    if args.metrics_file is not None:
+        metrics.start_file_writer(args.metrics_file)
+
+    ## received messages are queued for the ingest workers from the SDK thread
+    cli_obj.ingest_queue = IngestQueue(cli_obj.handle_message, workers=args.ingest_workers,
+                                       max_depth=args.ingest_depth, overflow=args.ingest_overflow)
+
+    ## segments relayed to txtenna-server when not using a local bitcoind
+    cli_obj.segment_forwarder = SegmentForwarder(window=args.forward_window, spool_dir=args.spool_dir)
+
+    ## segments are stored with the configured limits and journal from the first one received
+    journal = SegmentJournal(args.journal) if args.journal is not None else None
+    cli_obj.segment_storage = SegmentStorage(max_payloads=args.max_payloads,
+                                             max_bytes=args.max_payload_bytes,
+                                             ttl=args.payload_ttl,
+                                             journal=journal)
+    cli_obj.payload_streams = PayloadStreams(cli_obj.segment_storage, cli_obj.open_message_sink)
+    cli_obj.pipe_file = args.pipe
+    cli_obj.receive_dir = args.receive_dir
+
+    ## use local bitcoind to confirm transactions if 'local' is true, including those resumed
+    cli_obj.local = args.local
+    cli_obj.zmq_url = args.zmq
+    cli_obj.resume_received_payloads()
 
     ## start goTenna SDK thread by setting the SDK token
     cli_obj.do_sdk_token(args.SDK_TOKEN)
@@ -796,16 +1171,29 @@ def run_cli():
     cli_obj.do_set_gid(_gid)
     print("set gid=",_gid)
 
-    ## use local bitcoind to confirm transactions if 'local' is true
-    cli_obj.local = args.local
+    ## receivers detect Z85 encoded transactions from the length of their hash
+    cli_obj.use_z85 = args.z85
+
+    ## receivers detect binary segments from their first byte
+    cli_obj.use_binary = args.binary
+
+    ## receivers recover lost segments of message data from parity segments
+    cli_obj.fec_parity = args.fec_parity
+
+    ## resend the segments that receivers report missing from our broadcasts
+    if args.nack_cache_bytes > 0:
+        cli_obj.sent_segments = SentSegmentCache(max_bytes=args.nack_cache_bytes)
 
     ## broadcast message data from files in this directory, eg. created by the blocksat
     cli_obj.send_dir = args.send_dir
+    cli_obj.broadcast_index_path = args.broadcast_index
     if (args.send_dir is not None):
         cli_obj.do_broadcast_messages(args.send_dir)
 
-    cli_obj.pipe_file = args.pipe
-    cli_obj.receive_dir = args.receive_dir
+    ## ask senders to resend the segments missing from incomplete payloads
+    if args.nack_timeout > 0:
+        cli_obj.nack_requester = RetransmitRequester(cli_obj.segment_storage, cli_obj.send_nack,
+                                                     gap_timeout=args.nack_timeout)
 
     try:
         sleep(5)
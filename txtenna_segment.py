@@ -8,10 +8,94 @@ import json
 from zmq.utils import z85
 import md5
 import string
+import struct
+import binascii
+import fec
+
+## Binary segments start with the version byte, JSON segments with '{'
+BINARY_VERSION = 1
+BINARY_FRAME_LEN = 210
+
+## most segments of a payload, data and parity, in either format, as sequence numbers are 16 bits in the binary format
+MAX_SEGMENT_COUNT = 0xffff
+
+## version, flags, payload id, sequence number
+BINARY_HEADER_FORMAT = '!BB8sH'
+## segment count, followed by the hash (32 bytes) or a length prefixed file name
+BINARY_HEAD_FORMAT = '!H'
+## version, flags, transaction hash, block height
+BINARY_CONFIRMATION_FORMAT = '!BB32sI'
+## payload length and parity segments per group, following the header of a parity segment
+BINARY_PARITY_FORMAT = '!IB'
+
+FLAG_HEAD = 0x01
+FLAG_CONFIRMATION = 0x02
+FLAG_TESTNET = 0x04
+FLAG_MESSAGE = 0x08
+FLAG_Z85 = 0x10
+FLAG_BASE64 = 0x20
+FLAG_PARITY = 0x40
+## the head segment of message data names its compression codec, after the file name
+FLAG_CODEC = 0x80
+
+## (bytes, characters) of the smallest unit of each payload text encoding
+PAYLOAD_UNITS = {
+    'hex': (1, 2),
+    'z85': (4, 5),
+    'base64': (3, 4)
+}
+
+def payload_to_bytes(payload, encoding):
+    """ Decode the hex or base64 payload text of a segment
+    """
+    if encoding == 'base64':
+        return binascii.a2b_base64(payload)
+    return binascii.unhexlify(payload)
+
+def payload_text_length(size, encoding):
+    """ Characters of payload text encoding size bytes, Z85 padded to whole units
+    """
+    (unit_bytes, unit_chars) = PAYLOAD_UNITS[encoding]
+    if encoding == 'hex':
+        return size * unit_chars
+    return (size + unit_bytes - 1) // unit_bytes * unit_chars
+
+def _split_text(chunks, first_len, rest_len):
+    """ Split the text read from chunks into a piece of first_len characters followed by pieces of rest_len
+
+    Yields a single empty piece if there is no text.
+    """
+    pieces = []
+    buffered = 0
+    want = first_len
+    split = False
+    for chunk in chunks:
+        pos = 0
+        while pos < len(chunk):
+            take = min(want - buffered, len(chunk) - pos)
+            pieces.append(chunk[pos:pos + take])
+            buffered += take
+            pos += take
+            if buffered == want:
+                yield ''.join(pieces)
+                split = True
+                pieces = []
+                buffered = 0
+                want = rest_len
+    if buffered or not split:
+        yield ''.join(pieces)
+
+def bytes_to_payload(data, encoding):
+    """ Encode bytes as hex or base64 payload text
+    """
+    if encoding == 'base64':
+        return binascii.b2a_base64(data).rstrip('\n')
+    return binascii.hexlify(data)
 
 class TxTennaSegment:
 
-    def __init__(self, payload_id, payload, tx_hash=None, sequence_num=0, testnet=False, segment_count=None, block=None, message=False):
+    def __init__(self, payload_id, payload, tx_hash=None, sequence_num=0, testnet=False, segment_count=None, block=None, message=False, encoding=None,
+                 fec_length=None, fec_parity=None, codec=None):
         self.segment_count = segment_count
         self.tx_hash = tx_hash
         self.payload_id = payload_id
@@ -20,6 +104,18 @@ class TxTennaSegment:
         self.payload = payload
         self.block = block
         self.message = message
+        ## text encoding of the payload, only needed to serialize to binary
+        if encoding is None:
+            encoding = 'base64' if message else 'hex'
+        self.encoding = encoding
+        ## only for parity segments: the length in bytes of the whole payload and the parity segments per FEC group
+        self.fec_length = fec_length
+        self.fec_parity = fec_parity
+        ## only for the head segment of message data: the compression codec, see compression.py
+        self.codec = codec
+
+    def is_parity(self):
+        return self.fec_parity is not None
 
     def __str__(self):
         return "Tx {self.tx_hash} Part {self.sequence_num}"
@@ -27,6 +123,18 @@ class TxTennaSegment:
     def __repr__(self):
         return self.serialize_to_json()
 
+    def is_z85(self):
+        """ True for the head segment of a transaction sent with Z85 encoding, identified by its 40 character hash
+        """
+        return self.tx_hash is not None and not self.message and len(self.tx_hash) == 40
+
+    def get_hex_tx_hash(self):
+        """ Transaction hash as hex, decoded from Z85 if needed
+        """
+        if self.is_z85():
+            return z85.decode(str(self.tx_hash)).encode("hex")
+        return self.tx_hash
+
     def serialize_to_json(self):
         data = {
             "i": self.payload_id,
@@ -46,6 +154,13 @@ class TxTennaSegment:
         if self.message:
             data["n"] = "d"
 
+        if self.codec is not None:
+            data["z"] = self.codec
+
+        if self.is_parity():
+            data["l"] = self.fec_length
+            data["r"] = self.fec_parity
+
         # transaction confirmations contain only two elements
         if self.block:
             data = {
@@ -55,8 +170,113 @@ class TxTennaSegment:
 
         return json.dumps(data,separators=(',',':'))
 
+    def serialize_to_binary(self):
+        """ Serialize to the compact binary format, with the payload as raw bytes instead of text
+        """
+        if self.block is not None:
+            flags = FLAG_CONFIRMATION
+            return struct.pack(BINARY_CONFIRMATION_FORMAT, BINARY_VERSION, flags,
+                               binascii.unhexlify(self.get_hex_tx_hash()), self.block)
+
+        flags = 0
+        if self.testnet:
+            flags |= FLAG_TESTNET
+        if self.message:
+            flags |= FLAG_MESSAGE
+        if self.encoding == 'z85':
+            flags |= FLAG_Z85
+            payload = z85.decode(str(self.payload))
+            payload_id = z85.decode(str(self.payload_id))
+        else:
+            if self.encoding == 'base64':
+                flags |= FLAG_BASE64
+                payload = binascii.a2b_base64(self.payload)
+            else:
+                payload = binascii.unhexlify(self.payload)
+            payload_id = binascii.unhexlify(self.payload_id)
+
+        head = ''
+        if self.is_parity():
+            flags |= FLAG_PARITY
+            head = struct.pack(BINARY_PARITY_FORMAT, self.fec_length, self.fec_parity)
+        elif self.sequence_num == 0:
+            flags |= FLAG_HEAD
+            head = struct.pack(BINARY_HEAD_FORMAT, self.segment_count)
+            if self.message:
+                head += chr(len(self.tx_hash)) + self.tx_hash
+                if self.codec is not None:
+                    flags |= FLAG_CODEC
+                    head += self.codec
+            else:
+                head += binascii.unhexlify(self.get_hex_tx_hash())
+
+        header = struct.pack(BINARY_HEADER_FORMAT, BINARY_VERSION, flags, payload_id, self.sequence_num)
+        return header + head + payload
+
+    @classmethod
+    def deserialize_from_binary(cls, data):
+        (version, flags) = struct.unpack_from('!BB', data)
+        if version != BINARY_VERSION:
+            raise AttributeError('Unsupported binary segment version {}'.format(version))
+
+        if flags & FLAG_CONFIRMATION:
+            (_, _, tx_hash, block) = struct.unpack_from(BINARY_CONFIRMATION_FORMAT, data)
+            return cls('', '', tx_hash=binascii.hexlify(tx_hash), block=block)
+
+        (_, _, payload_id, sequence_num) = struct.unpack_from(BINARY_HEADER_FORMAT, data)
+        offset = struct.calcsize(BINARY_HEADER_FORMAT)
+        testnet = bool(flags & FLAG_TESTNET)
+        message = bool(flags & FLAG_MESSAGE)
+
+        segment_count = None
+        tx_hash = None
+        fec_length = None
+        fec_parity = None
+        codec = None
+        if flags & FLAG_PARITY:
+            (fec_length, fec_parity) = struct.unpack_from(BINARY_PARITY_FORMAT, data, offset)
+            offset += struct.calcsize(BINARY_PARITY_FORMAT)
+        elif flags & FLAG_HEAD:
+            (segment_count,) = struct.unpack_from(BINARY_HEAD_FORMAT, data, offset)
+            offset += struct.calcsize(BINARY_HEAD_FORMAT)
+            if message:
+                hash_len = ord(data[offset])
+                tx_hash = data[offset+1:offset+1+hash_len]
+                offset += 1 + hash_len
+                if flags & FLAG_CODEC:
+                    codec = data[offset]
+                    offset += 1
+            else:
+                tx_hash = data[offset:offset+32]
+                offset += 32
+
+        payload = data[offset:]
+        if flags & FLAG_Z85:
+            encoding = 'z85'
+            payload = z85.encode(payload)
+            payload_id = z85.encode(payload_id)
+            if tx_hash is not None:
+                tx_hash = z85.encode(tx_hash)
+        else:
+            encoding = 'base64' if flags & FLAG_BASE64 else 'hex'
+            if encoding == 'base64':
+                payload = binascii.b2a_base64(payload).rstrip('\n')
+            else:
+                payload = binascii.hexlify(payload)
+            payload_id = binascii.hexlify(payload_id)
+            if tx_hash is not None and not message:
+                tx_hash = binascii.hexlify(tx_hash)
+
+        return cls(payload_id, payload, tx_hash=tx_hash, sequence_num=sequence_num, testnet=testnet, segment_count=segment_count, message=message, encoding=encoding,
+                   fec_length=fec_length, fec_parity=fec_parity, codec=codec)
+
     @classmethod
     def deserialize_from_json(cls, json_string):
+        """ Deserialize a JSON segment, or a binary segment identified by its version byte
+        """
+        if json_string[:1] == chr(BINARY_VERSION):
+            return cls.deserialize_from_binary(json_string)
+
         data = json.loads(json_string)
 
         # Validate
@@ -83,7 +303,15 @@ class TxTennaSegment:
         # Block confirmation
         block = data["b"] if "b" in data else None
 
-        return cls( payload_id, payload, tx_hash=tx_hash, sequence_num=sequence_num, testnet=testnet, segment_count=segment_count, block=block,message=message)
+        # Parity segments
+        fec_length = data["l"] if "l" in data else None
+        fec_parity = data["r"] if "r" in data else None
+
+        # Compression codec of message data
+        codec = data["z"] if "z" in data else None
+
+        return cls( payload_id, payload, tx_hash=tx_hash, sequence_num=sequence_num, testnet=testnet, segment_count=segment_count, block=block,message=message,
+                    fec_length=fec_length, fec_parity=fec_parity, codec=codec)
 
     @classmethod
     def segment_json_is_valid(cls, data):
@@ -96,32 +324,107 @@ class TxTennaSegment:
                 ("b" in data and data["b"] >= 0 and "h" in data))
 
     @classmethod
-    def tx_to_segments(self, gid, strHexTx, strHexTxHash, messageIdx=0, network='m', isZ85=False):
+    def tx_to_segments(self, gid, strHexTx, strHexTxHash, messageIdx=0, network='m', isZ85=False, isBinary=False, parity=0, codec=None):
+        """ List of the segments of strHexTx, hex transaction data or base64 message data, see iter_segments
+        """
+        strRaw = strHexTx
+        if isZ85 and network != 'd' :
+            ## Z85 encodes 4 bytes at a time, pad the transaction with zero bytes
+            txBytes = strHexTx.decode("hex")
+            txBytes += '\0' * (-len(txBytes) % 4)
+            strRaw = z85.encode(txBytes)
+            size = len(txBytes)
+        elif network == 'd' :
+            size = len(binascii.a2b_base64(strRaw))
+        else :
+            size = len(strRaw) // 2
+
+        return list(self.iter_segments(gid, [strRaw], size, strHexTxHash, messageIdx, network, isZ85, isBinary, parity, codec))
+
+    @classmethod
+    def iter_segments(self, gid, chunks, size, strHexTxHash, messageIdx=0, network='m', isZ85=False, isBinary=False, parity=0, codec=None):
+        ##
+        ## Generate the segments of size bytes of payload, read as text in its encoding from the chunks iterable.
+        ## The text is only held a segment at a time, and a group of segments at a time for parity.
         ##
         ## if Z85 encoding, use 24 extra characters for tx in segment0. Hash encoded on 40 characters instead of 64
         ##
+        ## if binary, size the segments to fill a BINARY_FRAME_LEN frame with raw payload bytes. Payloads
+        ## are split on whole units of their text encoding so each segment converts to bytes on its own.
+        ##
+        ## if parity, add that many Reed-Solomon parity segments for each group of fec.FEC_GROUP segments,
+        ## numbered after the last data segment, and repeat the head segment, which parity cannot recover.
+        ##
+        ## if codec, name the compression codec of message data in the head segment.
+        ##
         ## This method translated to python from txTenna app PayloadFactory.java : toJSON method
         ##
         ## JSON Parameters
         ##    * **s** - `integer` - Number of segments for the transaction. Only used in the first segment for a given transaction.
-        ##    * **h** - `string` - Hash of the transaction. Only used in the first segment for a given transaction. May be Z85-encoded.
+        ##    * **h** - `string` - Hash of the transaction. Only used in the first segment for a given transaction. May be Z85-encoded, which receivers detect by its length.
         ##    * **n** - `char` (optional) - Network to use. 't' for TestNet3, 'd' for message data, otherwise assume MainNet. Only used in the first segment for a given transaction.
         ##    * **i** - `string` - TxTenna unid identifying the transaction (8 bytes).
         ##    * **c** - `integer` - Sequence number for this segment. May be omitted in first segment for a given transaction (assumed to be 0).
-        ##    * **t** - `string` - Hex transaction data for this segment. May be Z85-encoded.
+        ##    * **t** - `string` - Hex transaction data for this segment. May be Z85-encoded, padded with zero bytes to a multiple of 4 bytes.
         ##    * **b** - `integer` - Block height of corresponding transaction hash. Will be 0 for mempool transactions.
+        ##    * **l** - `integer` - Length in bytes of the decoded payload. Only used in parity segments.
+        ##    * **r** - `integer` - Number of parity segments for each group of segments. Only used in parity segments.
+        ##    * **z** - `char` (optional) - Compression codec of message data, see compression.py. Only used in the first segment for message data, zlib if omitted.
 
         segment0Len = 100  ## 110?
         segment1Len = 180  ## 190?
 
-        if isZ85 : 
-            segment0Len += 24
+        if isZ85 and network == 'd' :
+            raise ValueError("Z85 encoding is only supported for transactions")
 
-        strRaw = strHexTx
+        if codec is not None and network != 'd' :
+            raise ValueError("A compression codec is only supported for message data")
+
+        if isZ85 and parity :
+            raise ValueError("FEC parity segments are not supported with Z85 encoding")
+
+        ## the Z85 hash uses 24 fewer characters and the Z85 id 6 fewer than hex
         if isZ85 :
-            strRaw = z85.encode(strHexTx)
+            segment0Len += 30
+            segment1Len += 6
+
+        ## the "z" field uses 8 characters
+        if codec is not None :
+            segment0Len -= 8
+
+        if network == 'd' :
+            encoding = 'base64'
+        elif isZ85 :
+            encoding = 'z85'
+        else :
+            encoding = 'hex'
+
+        ## data segments leave room for the "l" and "r" fields of a parity segment, in whole units of the encoding
+        if parity :
+            segment1Len -= len(',"l":{},"r":{}'.format(size, parity))
+            segment1Len -= segment1Len % PAYLOAD_UNITS[encoding][1]
+
+        if isBinary :
+            (unit_bytes, unit_chars) = PAYLOAD_UNITS[encoding]
+            header_len = struct.calcsize(BINARY_HEADER_FORMAT)
+            head_len = header_len + struct.calcsize(BINARY_HEAD_FORMAT)
+            if codec is not None :
+                head_len += 1
+            if network == 'd' :
+                ## the file name follows its length in one byte, and leaves room for a unit of data
+                max_name_len = min(0xff, BINARY_FRAME_LEN - head_len - 1 - unit_bytes)
+                if len(strHexTxHash) > max_name_len :
+                    raise ValueError("File name too long for a binary head segment, at most {} bytes".format(max_name_len))
+                head_len += 1 + len(strHexTxHash)
+            else :
+                head_len += 32
+            segment0Len = (BINARY_FRAME_LEN - head_len) // unit_bytes * unit_chars
+            ## data segments leave room for the fields of a parity segment of the same length
+            if parity :
+                header_len += struct.calcsize(BINARY_PARITY_FORMAT)
+            segment1Len = (BINARY_FRAME_LEN - header_len) // unit_bytes * unit_chars
 
-        length = len(strRaw)
+        length = payload_text_length(size, encoding)
 
         seg_count = 0
         if length <= segment0Len :
@@ -133,6 +436,9 @@ class TxTennaSegment:
             if length % segment1Len > 0 :
                 seg_count += 1
 
+        if seg_count + fec.parity_count(seg_count, parity) > MAX_SEGMENT_COUNT :
+            raise ValueError("Too many segments, at most {} can be sent".format(MAX_SEGMENT_COUNT))
+
         tx_id = messageIdx
 
         # a unique identifier for set of segments from a particular node
@@ -143,44 +449,45 @@ class TxTennaSegment:
             md5_hash = md5.new(buf).digest()
             idBytes = md5_hash[:8] ## first 8 bytes of md5 digest
             if isZ85 :
-                tx_id = z85.encode(idBytes.encode("hex"))
+                tx_id = z85.encode(idBytes)
             else :
                 tx_id = idBytes.encode("hex")
         except Exception: # pylint: disable=broad-except
-            return None
-
-        ret = []
-        for seg_num in range(0, seg_count) :
+            return
 
+        if isZ85 :
+            tx_hash = z85.encode(strHexTxHash.decode("hex"))
+        else :
+            tx_hash = strHexTxHash
+        testnet = network is 't' ## testnet
+        message = network is 'd' ## data network
+
+        ## parity blocks are as long as the longest data block, a whole segment1Len unless there are only the head and the last
+        (unit_bytes, unit_chars) = PAYLOAD_UNITS[encoding]
+        parity_len = segment1Len // unit_chars * unit_bytes if seg_count > 2 else None
+
+        head = None
+        group = []
+        parity_seq = seg_count
+        for (seg_num, tx_seg) in enumerate(_split_text(chunks, segment0Len, segment1Len)) :
             if seg_num == 0 :
-                if isZ85 :
-                    tx_hash = z85.encode(strHexTxHash.decode("hex"))
-                else :
-                    tx_hash = strHexTxHash
-
-                seg_len = len(strRaw)
-
-                tx_seg = strRaw
-                if seg_len > segment0Len :
-                    seg_len = segment0Len
-                    tx_seg = strRaw[:seg_len]
-                    strRaw = strRaw[seg_len:]
-                
-                testnet = network is 't' ## testnet
-                message = network is 'd' ## data network
-                rObj = TxTennaSegment(tx_id, tx_seg, tx_hash=tx_hash, segment_count=seg_count, testnet=testnet, message=message)
-                ret.append(rObj)
-
+                head = TxTennaSegment(tx_id, tx_seg, tx_hash=tx_hash, segment_count=seg_count, testnet=testnet, message=message, encoding=encoding,
+                                      codec=codec)
+                rObj = head
             else :
-                seg_len = len(strRaw)
-                tx_seg = strRaw
-                if seg_len > segment1Len :
-                    seg_len = segment1Len
-                    tx_seg = strRaw[:seg_len]
-                    strRaw = strRaw[seg_len:]
-
-                rObj = TxTennaSegment(tx_id, tx_seg, sequence_num=seg_num)
-                ret.append(rObj)
-
-        return ret
+                rObj = TxTennaSegment(tx_id, tx_seg, sequence_num=seg_num, encoding=encoding)
+            yield rObj
+
+            ## parity segments for each group follow its data segments
+            if parity :
+                group.append(payload_to_bytes(tx_seg, encoding))
+                if len(group) == fec.FEC_GROUP or seg_num == seg_count - 1 :
+                    for block in fec.encode(group, parity, parity_len) :
+                        yield TxTennaSegment(tx_id, bytes_to_payload(block, encoding), sequence_num=parity_seq, encoding=encoding,
+                                             fec_length=size, fec_parity=parity)
+                        parity_seq += 1
+                    group = []
+
+        if parity :
+            yield head
 